@@ -1,12 +1,32 @@
+import os
 from functools import reduce
-from typing import Callable, Tuple
+from typing import Callable
 
 import snowflake.connector.errors as snow_errors
 from snow_control.control_state import ControlState
+from snow_control.load import load_grant_snapshot, write_grant_snapshot
+from snow_control.sqlpriv import gen_entry_query
 from snow_control.styling import GREEN_CHECKMARK, RED_X, print_execution
 
+# Statements apply(method="batch") sends to Snowflake in a single multi-statement request
+APPLY_BATCH_SIZE = int(os.environ.get("CONTROL_APPLY_BATCH_SIZE", 100))
 
-def apply(state: ControlState, executables: list[str], plan_id: int, method="seq"):
+
+def apply(
+    state: ControlState,
+    executables: list[str],
+    plan_id: int,
+    method="seq",
+    plan_entries: list = None,
+    batch_size=APPLY_BATCH_SIZE,
+) -> dict:
+    """
+    Returns the outcome of each executed query: {qid: {"text": query, "result": errno (0 if it succeeded),
+    "entries": the plan entries of the query}}. {plan_entries} are the entries each of {executables}
+    executes (see gen_plan_queries). A query on several privileges that fails is executed again
+    one privilege at a time: a single privilege that can't be granted doesn't hold back the others.
+    With method="batch", {batch_size} queries are sent at a time (see execute_batch)
+    """
     cur = state.connection.cursor()
     current_role = list(cur.execute("SELECT CURRENT_ROLE()"))[0][0]
     grant_results = {}
@@ -14,21 +34,113 @@ def apply(state: ControlState, executables: list[str], plan_id: int, method="seq
         print(
             "Control plans can only be executed by an ACCOUNTADMIN"
         )  # TODO: change? "CONTROL ROLE"
-        return
+        return grant_results
+    queries = list(zip(executables, plan_entries or [[] for _ in executables]))
     if method == "seq":
-        for query in executables:
-            qid, result = sequential_query_execute(state=state, executable_query=query)
-            grant_results[qid] = {"text": query, "result": result}
-            if result:
-                print("\n")
-            else:
-                print(GREEN_CHECKMARK)
+        for query, entries in queries:
+            for qid, info in execute_plan_query(state, query, entries).items():
+                grant_results[qid] = info
+                if info["result"]:
+                    print("\n")
+                else:
+                    print(GREEN_CHECKMARK)
+    elif method == "batch":
+        for start in range(0, len(queries), batch_size):
+            grant_results |= execute_batch(state, queries[start : start + batch_size])
     else:
-        single_grant_func = lambda q: execute_and_retrieve_grant_result(state, q)
-        result_iterator = state.executor.map(single_grant_func, executables)
-        grant_results = reduce(lambda x, y: x | y, result_iterator)
+        single_grant_func = lambda q: execute_plan_query(state, *q, print_seq=False)
+        result_iterator = state.executor.map(single_grant_func, queries)
+        grant_results = reduce(lambda x, y: x | y, result_iterator, {})
         for qid, info in grant_results.items():
             result_symbol = RED_X if info["result"] else GREEN_CHECKMARK
+    return grant_results
+
+
+def execute_plan_query(
+    state: ControlState, executable_query: str, entries: list, print_seq=True
+) -> dict:
+    """
+    Executes a query of the plan, then the query of each of its {entries} if it failed
+    """
+    qid, errno = sequential_query_execute(state, executable_query, print_seq)
+    grant_results = {
+        qid: {"text": executable_query, "result": errno, "entries": entries}
+    }
+    if errno and len(entries) > 1:
+        for entry in entries:
+            grant_results |= execute_plan_query(
+                state, " ".join(gen_entry_query(entry)), [entry], print_seq
+            )
+    return grant_results
+
+
+def execute_batch(state: ControlState, queries: list, print_seq=True) -> dict:
+    """
+    Executes (query, plan entries) {queries} in a single multi-statement request, a network round trip
+    for all of them. Snowflake stops at the first statement that fails: the batch is then executed again
+    in two halves, down to single queries (see execute_plan_query). Repeating the grants/revokes
+    that went through before the failure is harmless
+    """
+    if len(queries) == 1:
+        return execute_plan_query(state, *queries[0], print_seq)
+    with state.checkout() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                ";\n".join(query for query, _ in queries), num_statements=len(queries)
+            )
+            # The query id of each statement, without fetching their results one by one
+            qids = cursor.multi_statement_savedIds
+        except snow_errors.ProgrammingError:
+            qids = None
+    if qids is None:
+        half = len(queries) // 2
+        return execute_batch(state, queries[:half], print_seq) | execute_batch(
+            state, queries[half:], print_seq
+        )
+    grant_results = {}
+    for qid, (query, entries) in zip(qids, queries):
+        if print_seq:
+            print_execution(query, success="+")
+        grant_results[qid] = {"text": query, "result": 0, "entries": entries}
+    return grant_results
+
+
+def record_applied_grants(account: str, grant_results: dict) -> None:
+    """
+    Applies the grants/revokes of the .snowplan that succeeded to the grant snapshot of the account,
+    so the next plan doesn't need to retrieve the grants of the roles again
+    """
+    executed = {}
+    for info in grant_results.values():
+        if info["result"]:
+            continue
+        for kind, role, delta_type, grant in info.get("entries", ()):
+            if kind == "ROLES":
+                executed.setdefault(role, {"to_revoke": set(), "to_grant": set()})
+                executed[role][delta_type].add(grant)
+    snapshot = load_grant_snapshot(account)
+    for role, role_executed in executed.items():
+        for grant_type, is_future in (("current", False), ("future", True)):
+            snapshot.update(
+                role,
+                grant_type,
+                granted={
+                    g
+                    for g in role_executed["to_grant"]
+                    if is_future_grant(g) == is_future
+                },
+                revoked={
+                    g
+                    for g in role_executed["to_revoke"]
+                    if is_future_grant(g) == is_future
+                },
+            )
+    write_grant_snapshot(account, snapshot)
+
+
+def is_future_grant(grant: tuple) -> bool:
+    return grant[1].startswith("FUTURE ")
 
 
 def snowflake_query_error_handling(query_calling_function: Callable):
@@ -45,26 +157,19 @@ def sequential_query_execute(
     state: ControlState, executable_query: str, print_seq=True
 ) -> dict:
     result = -1
-    cursor = state.connection.cursor()
-    try:
-        cursor.execute(executable_query)
-        if print_seq:
-            print_execution(executable_query, success="+")
-        result = 0
-    except snow_errors.ProgrammingError as pe:
-        if print_seq:
-            print_execution(executable_query, success="-")
-        result = pe.errno
-    finally:
-        return (cursor.sfqid, result)
-
-
-def execute_and_retrieve_grant_result(
-    state: ControlState, executable_query: str
-) -> Tuple[str, int]:
-    cursor = state.connection.cursor()
-    qid, errno = sequential_query_execute(state, executable_query, print_seq=False)
-    return {qid: {"text": executable_query, "result": errno}}
+    with state.checkout() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(executable_query)
+            if print_seq:
+                print_execution(executable_query, success="+")
+            result = 0
+        except snow_errors.ProgrammingError as pe:
+            if print_seq:
+                print_execution(executable_query, success="-")
+            result = pe.errno
+        finally:
+            return (cursor.sfqid, result)
 
 
 def log_executed_quereis(state: ControlState, plan_id: int, grant_results: dict):
@@ -0,0 +1,54 @@
+import time
+from typing import Hashable, Iterator, Tuple
+
+import snowflake.connector as snowcon
+from snowflake.connector.cursor import SnowflakeCursor
+from snowflake.connector.errors import ProgrammingError
+
+# Seconds between two status checks on queries that are still running
+ASYNC_POLL_INTERVAL = 0.25
+
+
+def wait_for_queries(
+    conn: snowcon.SnowflakeConnection,
+    pending: dict[Hashable, str],
+    errors: dict = None,
+) -> Iterator[Tuple[Hashable, str]]:
+    """
+    Yields the (key, qid) of asynchronously submitted queries, in the order they finish.
+    Queries added to {pending} while iterating are waited on as well, so a caller can
+    submit a follow-up query as soon as the one it depends on is done.
+    Raises the ProgrammingError of any query that failed, unless an {errors} dict is given:
+    failed queries are then yielded like the others, with their error stored in {errors} under their key
+    """
+    while pending:
+        finished = [
+            key for key, qid in list(pending.items()) if is_done(conn, key, qid, errors)
+        ]
+        for key in finished:
+            yield key, pending.pop(key)
+        if not finished:
+            time.sleep(ASYNC_POLL_INTERVAL)
+
+
+def is_done(conn: snowcon.SnowflakeConnection, key, qid: str, errors: dict) -> bool:
+    try:
+        return not conn.is_still_running(conn.get_query_status_throw_if_error(qid))
+    except ProgrammingError as e:
+        if errors is None:
+            raise
+        errors[key] = e
+        return True
+
+
+def query_results(conn: snowcon.SnowflakeConnection, qid: str) -> SnowflakeCursor:
+    """
+    A cursor over the results of the finished query {qid}, downloaded straight from the query
+    (GET /queries/{qid}/result). cursor.get_results_from_sfqid would run
+    `select * from table(result_scan(...))` to read them, one more query per result
+    """
+    return conn.cursor().query_result(qid)
+
+
+def fetch_query_results(conn: snowcon.SnowflakeConnection, qid: str) -> list:
+    return query_results(conn, qid).fetchall()
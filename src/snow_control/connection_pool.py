@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+import snowflake.connector as snowcon
+from snowflake.connector.errors import Error
+
+# Connections idle for longer than this are pinged before being handed out again
+HEALTH_CHECK_AFTER_SECONDS = 300
+HEALTH_CHECK_QUERY = "select 1"
+
+
+class ConnectionPool:
+    """
+    Authenticated Snowflake connections shared by the threads of the concurrent
+    scan, plan and apply paths, each connection used by one thread at a time.
+    Connections are opened as needed (up to {size}) through {connect}, and set up through {setup}
+    (eg set_environment) before their first use. Connections that were closed, or fail their
+    health check after sitting idle, are dropped and replaced
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], snowcon.SnowflakeConnection],
+        size: int = 1,
+        setup: Callable[[snowcon.SnowflakeConnection], None] = None,
+        connections: list[snowcon.SnowflakeConnection] = [],
+    ):
+        self.size = max(size, len(connections), 1)
+        self._connect = connect
+        self._setup = setup
+        self._idle = queue.LifoQueue()
+        self._last_used = {}
+        self._opened = len(connections)
+        self._lock = threading.Lock()
+        for conn in connections:
+            self.checkin(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[snowcon.SnowflakeConnection]:
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def checkout(self, timeout: float = None) -> snowcon.SnowflakeConnection:
+        """
+        An idle connection, a new one if none is idle and the pool isn't full,
+        otherwise waits up to {timeout} seconds (forever by default) for one to be checked in
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open() or self._idle.get(timeout=timeout)
+            if self.is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def checkin(self, conn: snowcon.SnowflakeConnection) -> None:
+        if conn.is_closed():
+            self._discard(conn)
+            return
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.put(conn)
+
+    def is_healthy(self, conn: snowcon.SnowflakeConnection) -> bool:
+        if conn.is_closed():
+            return False
+        idle_since = self._last_used.get(id(conn), time.monotonic())
+        if time.monotonic() - idle_since < HEALTH_CHECK_AFTER_SECONDS:
+            return True
+        try:
+            conn.cursor().execute(HEALTH_CHECK_QUERY)
+            return True
+        except Error:
+            return False
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def _open(self) -> snowcon.SnowflakeConnection:
+        with self._lock:
+            if self._opened >= self.size:
+                return None
+            self._opened += 1
+        try:
+            conn = self._connect()
+            if self._setup:
+                self._setup(conn)
+        except BaseException:
+            with self._lock:
+                self._opened -= 1
+            raise
+        return conn
+
+    def _discard(self, conn: snowcon.SnowflakeConnection) -> None:
+        with self._lock:
+            self._opened -= 1
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Error:
+            pass
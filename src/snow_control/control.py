@@ -3,13 +3,19 @@ import os
 import snowflake.connector as snowcon
 from colorama import Fore, Style
 from colorama import init as colorama_init
-from snow_control.apply import apply
+from snow_control.apply import apply, record_applied_grants
+from snow_control.connection_pool import ConnectionPool
 from snow_control.control_state import ControlState
-from snow_control.get_objects import filter_objects, object_scan, save_cache
+from snow_control.get_objects import (
+    filter_objects,
+    incremental_object_scan,
+    object_scan,
+    save_cache,
+)
 from snow_control.load import *
-from snow_control.plan import plan, print_account_plan
+from snow_control.plan import plan, print_account_plan, refresh_grant_snapshot
 from snow_control.queries import SET_SEARCH_PATH
-from snow_control.sqlpriv import gen_queries
+from snow_control.sqlpriv import gen_plan_queries, gen_queries
 from snow_control.styling import *
 
 colorama_init(autoreset=True)
@@ -45,15 +51,33 @@ def interactive():
     if not password:
         print(f"PASSWORD is blank, starting SSO auth for user {user}")
 
-    conn = initialize_connection(account_name=account, username=user, password=password)
-    state = ControlState(verbosity=3)
+    parameters = connection_parameters(
+        account_name=account, username=user, password=password
+    )
+    conn = snowcon.connect(**parameters)
+    set_environment(conn)
+    state = ControlState(
+        verbosity=3,
+        normalize_in_sql=os.environ.get("CONTROL_NORMALIZE_IN_SQL") == "1",
+    )
     state.account, state.connection = account, conn
+    # With CONTROL_POOL_SIZE, the concurrent get/plan/apply paths draw connections from a pool
+    # (starting with conn), each used by one thread at a time. Otherwise they all share conn
+    if os.environ.get("CONTROL_POOL_SIZE"):
+        state.pool = ConnectionPool(
+            connect=lambda: snowcon.connect(**parameters),
+            size=int(os.environ["CONTROL_POOL_SIZE"]),
+            setup=set_environment,
+            connections=[conn],
+        )
     state.ignore_objects = get_ignored_object_patterns(state.account)
 
     # MAIN MENU
     os.system("clear")
     while menu_screen(state):
         os.system("clear")
+    if state.pool:
+        state.pool.close()
     conn.close()
     exit()
 
@@ -70,6 +94,20 @@ def initialize_connection(
     If password is not provided, SSO verification in an external browser is assumed
     The connection can be customized by kwargs passed.
     """
+    conn = snowcon.connect(
+        **connection_parameters(account_name, username, password, role, **kwargs)
+    )
+    set_environment(conn)
+    return conn
+
+
+def connection_parameters(
+    account_name: str,
+    username: str,
+    password: str,
+    role: str = "ACCOUNTADMIN",
+    **kwargs,
+) -> dict:
     assert role.endswith(
         "ADMIN"
     ), "An admin role is necessary to run this tool (even in a dry run)"
@@ -86,10 +124,7 @@ def initialize_connection(
         parameters["authenticator"] = "externalbrowser"
 
     parameters |= kwargs
-
-    conn = snowcon.connect(**parameters)
-    set_environment(conn)
-    return conn
+    return parameters
 
 
 def set_environment(conn: snowcon.SnowflakeConnection) -> None:
@@ -118,6 +153,11 @@ def menu_screen(st: ControlState) -> bool:
 
     method_sequential = "seq" in params
     method_concurrent = "conc" in params
+    method_async = "async" in params
+    method_sharded = "shard" in params
+    incremental = "delta" in params
+    bulk_grants = "bulk" in params
+    ok_counts = "counts" in params
     print(Style.RESET_ALL, end="")
 
     if response == "clear":
@@ -134,10 +174,17 @@ def menu_screen(st: ControlState) -> bool:
         st.print(
             f"Getting latest list of objects in account {Style.BRIGHT + Fore.YELLOW}{st.account}"
         )
-        objects = object_scan(st, method="seq" if method_sequential else "conc")
-        filtered = filter_objects(
-            st, objects, method="seq" if method_sequential else "conc"
-        )
+        scan_method = "async" if method_async else "shard" if method_sharded else "conc"
+        scan_method = "seq" if method_sequential else scan_method
+        if incremental:
+            objects = incremental_object_scan(st, method=scan_method)
+        else:
+            objects = object_scan(
+                st,
+                method=scan_method,
+                shard_by="schema" if "schema" in params else "database",
+            )
+        filtered = filter_objects(st, objects)
         save_cache(st, filtered)
     elif response == "plan":
         roles_string = cli_input(
@@ -148,29 +195,43 @@ def menu_screen(st: ControlState) -> bool:
             if roles_string
             else None
         )
+        plan_method = "async" if method_async else "conc"  # default conc
+        plan_method = "proc" if "proc" in params else plan_method
+        plan_method = "seq" if method_sequential else plan_method
         plan(
             state=st,
             account=st.account,
             roles_to_plan=target_roles,
-            method="seq" if method_sequential else "conc",  # default conc,
+            method=plan_method,
             plan_users=False if target_roles else True,
+            grant_source="account_usage" if bulk_grants else "show",
+            keep_ok=not ok_counts,
         )
         print_account_plan(st)
+    elif response == "grants":
+        st.print(
+            f"Retrieving the grants of every role in account {Style.BRIGHT + Fore.YELLOW}{st.account}"
+        )
+        refresh_grant_snapshot(
+            st, st.account, grant_source="account_usage" if bulk_grants else "show"
+        )
     elif response == "show":
         print_account_plan(st)
     elif response == "sql":
-        cache_plan = get_plan_from_cache(st.account)
-        queries = gen_queries(st.account, cache_plan)
+        queries = gen_queries(st.account)
         show(queries)
     elif response == "apply":
-        cache_plan = get_plan_from_cache(st.account)
-        executables = [" ".join(q) for q in gen_queries(st.account, cache_plan)]
-        apply(
+        queries = gen_plan_queries(st.account)
+        apply_method = "conc" if method_concurrent else "seq"  # default seq
+        apply_method = "batch" if "batch" in params else apply_method
+        grant_results = apply(
             st,
-            plan_id=cache_plan["plan_id"],
-            executables=executables,
-            method="conc" if method_concurrent else "seq",  # default seq
+            plan_id=read_plan_header(st.account)["plan_id"],
+            executables=[" ".join(q) for q, _ in queries],
+            method=apply_method,
+            plan_entries=[entries for _, entries in queries],
         )
+        record_applied_grants(st.account, grant_results)
     else:
         return False
     cli_input("\n" * 4 + "To continue press any key")
@@ -1,4 +1,5 @@
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from colorama import Fore, Style
 from snow_control.styling import *
@@ -7,22 +8,44 @@ from snow_control.styling import *
 class ControlState:
     __slots__ = (
         "connection",
+        "pool",
         "account",
         "executor",
         "snowcache",
         "snowplan",
+        "scan_times",
+        "grants",
+        "config",
+        "normalize_in_sql",
         "queries",
         "ignore_objects",
         "verbosity",
     )
 
-    def __init__(self, verbosity=3, max_workers=100):
+    def __init__(self, verbosity=3, max_workers=100, normalize_in_sql=False):
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
         self.verbosity = verbosity
+        self.normalize_in_sql = normalize_in_sql
+        self.scan_times = {}
+        self.pool = None
+        self.grants = None
+        self.config = None
 
     def __del__(self):
         self.executor.shutdown()
 
+    @contextmanager
+    def checkout(self):
+        """
+        A connection for the calling thread alone, from the pool
+        (the shared connection when there is no pool)
+        """
+        if self.pool is None:
+            yield self.connection
+            return
+        with self.pool.connection() as conn:
+            yield conn
+
     def print(self, message, verbosity_level=0, **kwargs):
         if verbosity_level <= self.verbosity:
             print(message, **kwargs)
@@ -40,64 +63,73 @@ class ControlState:
             Verbosity 1,2,3: Print empty space for categories that have no delta
             Verbosity 4+: Print "grant deltas" summary
         """
-        TABLE_FLIP = "(╯°□°)╯︵ ┻━┻"
         self.print("\n" * 4)
         for recipient, config in plan.items():
-            # NO DELTAS
-            if not config["to_revoke"] and not config["to_grant"]:
-                self.print(
-                    f"{Style.BRIGHT + Fore.YELLOW}{grants_to}: {recipient} \t {GREEN_CHECKMARK}",
-                    verbosity_level=2,
-                )
-                self.print(
-                    f'{Style.BRIGHT + Fore.CYAN}ALL_GOOD!:({len(config["ok"])}:0) {TABLE_FLIP}',
-                    verbosity_level=3,
-                    end="\n",
-                )
-            else:
-                print("\n")
-                self.print(f"{Style.BRIGHT + Fore.YELLOW}{grants_to}: {recipient}")
-
-                if config["to_revoke"] or self.verbosity >= 1:
-                    self.print(
-                        f"{Style.BRIGHT+Fore.CYAN}PRIVILEGES TO BE {Style.BRIGHT + Fore.RED}REVOKED:",
-                        end="\n\n",
-                    )
-                    for minus in sorted(
-                        config["to_revoke"], key=lambda x: x[1] + x[2] + x[0]
-                    ):
-                        self.print(Fore.RED + format_privilege(*minus, delta="-"))
-                    self.print("\n")
-                if config["to_grant"] or self.verbosity >= 1:
-                    self.print(
-                        f"{Style.BRIGHT+Fore.CYAN}PRIVILEGES TO BE {Style.BRIGHT + Fore.GREEN}GRANTED:",
-                        end="\n\n",
-                    )
-                    for minus in sorted(
-                        config["to_grant"], key=lambda x: x[1] + x[2] + x[0]
-                    ):
-                        self.print(Fore.GREEN + format_privilege(*minus, delta="-"))
-                    self.print("\n")
+            self.print_formatted_recipient(recipient, config, grants_to)
 
-            GRANT_SUMMARY_VERBOSITY = 4
-            self.print(
-                f"{Style.BRIGHT}Grant Deltas: {recipient}",
-                verbosity_level=GRANT_SUMMARY_VERBOSITY,
-            )
-            self.print(
-                f'{Style.BRIGHT+Fore.RED}- {len(config["to_revoke"])}',
-                verbosity_level=GRANT_SUMMARY_VERBOSITY,
-            )
-            self.print(
-                f'{Style.BRIGHT+Fore.CYAN}= {len(config["ok"])}',
-                verbosity_level=GRANT_SUMMARY_VERBOSITY,
-            )
+    def print_formatted_recipient(
+        self, recipient: str, config: dict, grants_to="ROLE"
+    ) -> None:
+        """
+        The part of print_formatted_plan about a single role/user
+        """
+        TABLE_FLIP = "(╯°□°)╯︵ ┻━┻"
+        ok_count = config["ok_count"] if "ok_count" in config else len(config["ok"])
+        # NO DELTAS
+        if not config["to_revoke"] and not config["to_grant"]:
             self.print(
-                f'{Style.BRIGHT+Fore.GREEN}+ {len(config["to_grant"])}',
-                verbosity_level=GRANT_SUMMARY_VERBOSITY,
+                f"{Style.BRIGHT + Fore.YELLOW}{grants_to}: {recipient} \t {GREEN_CHECKMARK}",
+                verbosity_level=2,
             )
-            self.print("==================", verbosity_level=GRANT_SUMMARY_VERBOSITY)
             self.print(
-                f'{Style.BRIGHT}T {len(config["to_revoke"]) + len(config["ok"]) + len(config["to_grant"])}',
-                verbosity_level=GRANT_SUMMARY_VERBOSITY,
+                f"{Style.BRIGHT + Fore.CYAN}ALL_GOOD!:({ok_count}:0) {TABLE_FLIP}",
+                verbosity_level=3,
+                end="\n",
             )
+        else:
+            print("\n")
+            self.print(f"{Style.BRIGHT + Fore.YELLOW}{grants_to}: {recipient}")
+
+            if config["to_revoke"] or self.verbosity >= 1:
+                self.print(
+                    f"{Style.BRIGHT+Fore.CYAN}PRIVILEGES TO BE {Style.BRIGHT + Fore.RED}REVOKED:",
+                    end="\n\n",
+                )
+                for minus in sorted(
+                    config["to_revoke"], key=lambda x: x[1] + x[2] + x[0]
+                ):
+                    self.print(Fore.RED + format_privilege(*minus, delta="-"))
+                self.print("\n")
+            if config["to_grant"] or self.verbosity >= 1:
+                self.print(
+                    f"{Style.BRIGHT+Fore.CYAN}PRIVILEGES TO BE {Style.BRIGHT + Fore.GREEN}GRANTED:",
+                    end="\n\n",
+                )
+                for minus in sorted(
+                    config["to_grant"], key=lambda x: x[1] + x[2] + x[0]
+                ):
+                    self.print(Fore.GREEN + format_privilege(*minus, delta="-"))
+                self.print("\n")
+
+        GRANT_SUMMARY_VERBOSITY = 4
+        self.print(
+            f"{Style.BRIGHT}Grant Deltas: {recipient}",
+            verbosity_level=GRANT_SUMMARY_VERBOSITY,
+        )
+        self.print(
+            f'{Style.BRIGHT+Fore.RED}- {len(config["to_revoke"])}',
+            verbosity_level=GRANT_SUMMARY_VERBOSITY,
+        )
+        self.print(
+            f"{Style.BRIGHT+Fore.CYAN}= {ok_count}",
+            verbosity_level=GRANT_SUMMARY_VERBOSITY,
+        )
+        self.print(
+            f'{Style.BRIGHT+Fore.GREEN}+ {len(config["to_grant"])}',
+            verbosity_level=GRANT_SUMMARY_VERBOSITY,
+        )
+        self.print("==================", verbosity_level=GRANT_SUMMARY_VERBOSITY)
+        self.print(
+            f'{Style.BRIGHT}T {len(config["to_revoke"]) + ok_count + len(config["to_grant"])}',
+            verbosity_level=GRANT_SUMMARY_VERBOSITY,
+        )
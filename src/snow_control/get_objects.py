@@ -1,128 +1,592 @@
 import json
 from concurrent.futures import ThreadPoolExecutor
-from itertools import repeat
-from time import localtime, strftime
-from typing import Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Iterable, Tuple
 
 import snowflake.connector as snowcon
+from snow_control.async_query import query_results, wait_for_queries
 from snow_control.control_state import ControlState
 from snow_control.load import *
 from snow_control.queries import *
 from snow_control.sf_object_structures import *
 from snow_control.styling import time_func
 
+# Cached object types that filter_objects splits off of the object type they were scanned as
+SPLIT_OBJECT_TYPES = {
+    "shared database": "database",
+    "application database": "database",
+    "internal stage": "stage",
+    "external stage": "stage",
+    "materialized view": "view",
+    "external table": "table",
+}
+# Objects in databases matching this pattern are dropped by filter_objects
+IGNORE_DB_PATTERN = r".*_(DEV|QA|PROD)_[0-9]{1,5}"
+# Past this many unknown objects, a delta scan retrieves the whole object type instead
+MAX_DELTA_NAMES = 1000
+# Rows per page of a paginated show query (Snowflake caps show output at 10K rows)
+SHOW_PAGE_SIZE = 10000
+# Object types whose show query supports LIMIT ... FROM pagination
+PAGINATED_OBJECT_TYPES = ["schema", "table", "dynamic table", "view", "task", "stream"]
+
 
 @time_func
-def object_scan(state: ControlState, method="conc") -> dict:
+def object_scan(
+    state: ControlState, method="conc", shard_by="database", object_types=None
+) -> dict:
+    """
+    Retrieves the objects of every object type in the account (or only those in {object_types})
+    """
     objects = {}
     conn = state.connection
     tp_executor = state.executor
+    scanned_at = get_server_time(conn)
+    scan_types = {
+        obj_type: key
+        for obj_type, key in GET_FULL_NAME.items()
+        if object_types is None or obj_type in object_types
+    }
 
     def individual_object_scan(item: Tuple[str, list[str]]):
         obj_type, key = item
-        cur = conn.cursor()
-        formatted_query = (
-            INTEGRATION_SHOW_QUERY
-            if obj_type.upper().endswith("INTEGRATION")
-            else SHOW_QUERY
-        ).format(obj_type)
-        state.print(
-            f"Executing show query on object type {obj_type}", verbosity_level=4
-        )
-        cur.execute(formatted_query)
-        qid = cur.sfqid
-        state.print(
-            f"Retrieving objects of type {obj_type} in account", verbosity_level=3
-        )
-        panda = cur.execute(
-            NAME_QUERY.format(qid=qid, key=",".join([f'"{s}"' for s in key]))
-        ).fetch_pandas_all()
-
-        if obj_type.upper() in ("PROCEDURE", "FUNCTION"):
-            panda = panda[panda["is_builtin"] == "N"]
-        panda["FULL_NAME"] = panda["FULL_NAME"].apply(
-            lambda x: process_name(x.replace(" RETURN ", ":"), obj_type.upper())
-        )
-        panda = panda[
-            panda["FULL_NAME"].apply(
-                lambda name: not object_matches_any(name, state.ignore_objects)
-            )
-        ]
-
-        return (obj_type, panda)
+        with state.checkout() as pooled:
+            cur = pooled.cursor()
+            qid = show_objects(state, cur, obj_type)
+            return (obj_type, retrieve_objects(state, cur, qid, obj_type, key))
 
     if method == "seq":
-        for obj_type, full_name_columns in GET_FULL_NAME.items():
+        for obj_type, full_name_columns in scan_types.items():
             print(obj_type)
             print(full_name_columns)
             _, result_df = individual_object_scan((obj_type, full_name_columns))
             objects[obj_type] = result_df
+    elif method == "async":
+        objects = async_object_scan(state, object_types=scan_types)
+    elif method == "shard":
+        objects = sharded_object_scan(state, shard_by=shard_by)
+        objects = {obj_type: objects[obj_type] for obj_type in scan_types}
     else:
-        results = tp_executor.map(individual_object_scan, GET_FULL_NAME.items())
+        results = tp_executor.map(individual_object_scan, scan_types.items())
         for obj_type, result_df in results:
             objects[obj_type] = result_df
 
+    state.scan_times = {obj_type: scanned_at for obj_type in objects}
+    return objects
+
+
+@time_func
+def incremental_object_scan(state: ControlState, method="conc") -> dict:
+    """
+    Refreshes the cached registry of objects instead of retrieving every object in the account again.
+    For each object type:
+        1. Re-run the show query, but only retrieve the names of the objects
+        2. Retrieve the full record of objects created since the type was last scanned,
+           or whose name the cache doesn't know yet (eg renamed objects)
+        3. Drop cached objects that no longer exist in the account
+    Object types the cache has no scan time for are scanned in full.
+    Objects altered in place since the last scan keep their cached record: show queries don't say when
+    objects were altered, and none of the cached columns can change without a rename or a re-create.
+    Returns the objects unfiltered, same as object_scan
+    """
+    try:
+        cached, scan_times = load_snowcache(state.account)
+    except (FileNotFoundError, json.JSONDecodeError):
+        state.print("No usable cache of objects found, scanning all objects")
+        return object_scan(state, method)
+
+    objects = {}
+    conn = state.connection
+    scanned_at = get_server_time(conn)
+    ignore_dbs = get_cached_ignore_dbs(cached)
+
+    def individual_delta_scan(item: Tuple[str, list[str]]):
+        with state.checkout() as pooled:
+            return delta_scan(item, pooled.cursor())
+
+    def delta_scan(item: Tuple[str, list[str]], cur):
+        obj_type, key = item
+        since = scan_times.get(obj_type)
+        qid = show_objects(state, cur, obj_type)
+        if since is None:
+            return (obj_type, retrieve_objects(state, cur, qid, obj_type, key))
+
+        previous = get_cached_objects_of_type(cached, obj_type)
+        live = retrieve_live_names(state, cur, qid, obj_type, key)
+        # Objects the cache doesn't know about are either new, or were filtered out
+        # of the cache by the last scan: only the former need to be retrieved
+        unknown = live[~live["FULL_NAME"].isin(previous["FULL_NAME"])]
+        _, ignore_patterns = split_ignore_patterns(state, obj_type)
+        ignored = compile_patterns(ignore_patterns, re.IGNORECASE)
+        unknown = unknown[~ignored.mask(unknown["FULL_NAME"])]
+        _, unknown = filter_function(obj_type, unknown, ignore_dbs)
+        if obj_type == "view":
+            unknown = unknown[unknown["schema_name"] != "INFORMATION_SCHEMA"]
+
+        if len(unknown) > MAX_DELTA_NAMES:
+            return (obj_type, retrieve_objects(state, cur, qid, obj_type, key))
+
+        changed_filter = CREATED_SINCE_FILTER.format(since=since)
+        if len(unknown):
+            unknown_names = ",".join(sql_string(n) for n in unknown["RAW_NAME"])
+            full_name = full_name_sql(state, obj_type, key)
+            changed_filter += f" or {full_name} in ({unknown_names})"
+        changed = retrieve_objects(state, cur, qid, obj_type, key, where=changed_filter)
+        state.print(
+            f"Found {len(changed)} new or changed objects of type {obj_type}",
+            verbosity_level=3,
+        )
+
+        previous = previous[
+            previous["FULL_NAME"].isin(live["FULL_NAME"])
+            & ~previous["FULL_NAME"].isin(changed["FULL_NAME"])
+        ]
+        return (obj_type, pd.concat([previous, changed], ignore_index=True))
+
+    if method == "seq":
+        results = map(individual_delta_scan, GET_FULL_NAME.items())
+    else:
+        results = state.executor.map(individual_delta_scan, GET_FULL_NAME.items())
+    for obj_type, result_df in results:
+        objects[obj_type] = result_df
+
+    state.scan_times = scan_times | {obj_type: scanned_at for obj_type in objects}
+    return objects
+
+
+@time_func
+def refresh_stale_objects(
+    state: ControlState, object_types: Iterable[str], method="conc"
+) -> Mapping:
+    """
+    Returns the cached objects, after rescanning those of {object_types} that have gone stale:
+    scanned longer ago than their TTL in cache_ttl.yaml (see get_cache_ttls), or never scanned.
+    Only the stale object types are scanned, filtered and rewritten to the cache
+    """
+    try:
+        cached, scan_times = load_snowcache(state.account)
+    except (FileNotFoundError, json.JSONDecodeError):
+        state.print("No usable cache of objects found, scanning all objects")
+        objects = filter_objects(state, object_scan(state, method))
+        entries = write_snowcache(state.account, objects, state.scan_times)
+        return ObjectRegistry(get_snowcache_dir(state.account), entries, objects)
+
+    ttls = get_cache_ttls(state.account)
+    scan_types = {
+        SPLIT_OBJECT_TYPES.get(obj_type, obj_type) for obj_type in object_types
+    }
+    stale = [
+        obj_type
+        for obj_type in GET_FULL_NAME
+        if obj_type in scan_types
+        and is_stale(scan_times.get(obj_type), ttls.get(obj_type, ttls.get("default")))
+    ]
+    if not stale:
+        return cached
+
+    state.print(f"Refreshing stale cached objects of type {', '.join(stale)}")
+    ignore_dbs = get_cached_ignore_dbs(cached)
+    refreshed = filter_objects(
+        state, object_scan(state, method, object_types=stale), ignore_dbs
+    )
+    if isinstance(cached, ObjectRegistry):
+        entries = update_snowcache(state.account, refreshed, state.scan_times)
+        return cached.updated(refreshed, entries)
+    objects = dict(cached) | refreshed
+    entries = write_snowcache(state.account, objects, scan_times | state.scan_times)
+    return ObjectRegistry(get_snowcache_dir(state.account), entries, objects)
+
+
+def get_cached_ignore_dbs(cached: Mapping) -> set:
+    """
+    The shared/application databases of the last scan, whose objects filter_objects drops
+    """
+    return {
+        name
+        for db_type in ("shared database", "application database")
+        if "name" in cached.get(db_type, {})
+        for name in cached[db_type]["name"]
+    }
+
+
+def is_stale(scanned_at: str, ttl: int) -> bool:
+    if scanned_at is None:
+        return True
+    if ttl is None:
+        return False
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(scanned_at).astimezone()
+    return age > timedelta(seconds=ttl)
+
+
+def async_object_scan(state: ControlState, object_types=GET_FULL_NAME) -> dict:
+    """
+    Submits the show query of every object type at once without waiting on any of them.
+    As each show query finishes, the query retrieving its objects is submitted,
+    and once that one finishes its results are downloaded on the executor.
+    The scan takes about as long as the slowest object type.
+    """
+    conn = state.connection
+    cur = conn.cursor()
+    pending, retrieving, downloads = {}, set(), []
+    for obj_type in object_types:
+        state.print(
+            f"Submitting show query on object type {obj_type}", verbosity_level=4
+        )
+        cur.execute_async(show_query(obj_type))
+        pending[obj_type] = cur.sfqid
+
+    for obj_type, qid in wait_for_queries(conn, pending):
+        if obj_type in retrieving:
+            downloads.append(
+                state.executor.submit(download_objects, state, obj_type, qid)
+            )
+            continue
+        state.print(
+            f"Submitting retrieval of objects of type {obj_type}", verbosity_level=4
+        )
+        key = GET_FULL_NAME[obj_type]
+        cur.execute_async(name_query(state, qid, obj_type, key))
+        pending[obj_type] = cur.sfqid
+        retrieving.add(obj_type)
+
+    return dict(download.result() for download in downloads)
+
+
+def download_objects(
+    state: ControlState, obj_type: str, qid: str
+) -> Tuple[str, pd.DataFrame]:
+    state.print(f"Retrieving objects of type {obj_type} in account", verbosity_level=3)
+    cur = query_results(state.connection, qid)
+    return (obj_type, process_objects(state, obj_type, cur.fetch_pandas_all()))
+
+
+def sharded_object_scan(state: ControlState, shard_by="database") -> dict:
+    """
+    Splits the show queries of schemas, namespace level objects (NLOs) and functions/procedures
+    into one show query per database (or schema with shard_by="schema"), run concurrently.
+    Paginated object types are retrieved SHOW_PAGE_SIZE rows at a time, so no container
+    is cut off at Snowflake's show output limit.
+    Shared and application databases are skipped, filter_objects drops their objects anyway
+    """
+    objects = {}
+
+    def individual_object_scan(obj_type: str):
+        with state.checkout() as conn:
+            cur = conn.cursor()
+            qid = show_objects(state, cur, obj_type)
+            key = GET_FULL_NAME[obj_type]
+            return (obj_type, retrieve_objects(state, cur, qid, obj_type, key))
+
+    def individual_shard_scan(item: Tuple[str, str]):
+        obj_type, container = item
+        scope = (
+            "schema" if shard_by == "schema" and obj_type != "schema" else "database"
+        )
+        with state.checkout() as conn:
+            return (obj_type, paged_show(state, conn, obj_type, scope, container))
+
+    for obj_type, result_df in state.executor.map(individual_object_scan, ALOs):
+        objects[obj_type] = result_df
+    dbs = objects["database"]
+    databases = [
+        quote_identifier(db)
+        for db in dbs[~dbs["kind"].isin(["IMPORTED DATABASE", "APPLICATION"])]["name"]
+    ]
+
+    schema_shards = [("schema", db) for db in databases]
+    objects["schema"] = concat_shards(
+        "schema",
+        [df for _, df in state.executor.map(individual_shard_scan, schema_shards)],
+    )
+    containers = (
+        [
+            f"{quote_identifier(db)}.{quote_identifier(schema)}"
+            for db, schema in objects["schema"][["database_name", "name"]].values
+        ]
+        if shard_by == "schema"
+        else databases
+    )
+
+    shards = [
+        (obj_type, container) for obj_type in NLOs + FNCs for container in containers
+    ]
+    results = {obj_type: [] for obj_type in NLOs + FNCs}
+    for obj_type, result_df in state.executor.map(individual_shard_scan, shards):
+        results[obj_type].append(result_df)
+    for obj_type, frames in results.items():
+        objects[obj_type] = concat_shards(obj_type, frames)
     return objects
 
 
+def paged_show(
+    state: ControlState,
+    conn: snowcon.SnowflakeConnection,
+    obj_type: str,
+    scope: str,
+    container: str,
+) -> pd.DataFrame:
+    """
+    Retrieve the objects of type {obj_type} in the database/schema {container}, following
+    the show query's LIMIT ... FROM cursor page by page where the object type supports it
+    """
+    cur = conn.cursor()
+    key = GET_FULL_NAME[obj_type]
+    pages, last_name = [], None
+    while True:
+        query = SHARDED_SHOW_QUERY.format(obj_type, scope=scope, container=container)
+        if obj_type in PAGINATED_OBJECT_TYPES:
+            query += f" limit {SHOW_PAGE_SIZE}"
+            if last_name is not None:
+                query += f" from {sql_string(last_name)}"
+        state.print(f"Executing {query}", verbosity_level=4)
+        cur.execute(query)
+        qid, shown = cur.sfqid, cur.rowcount
+        pages.append(retrieve_objects(state, cur, qid, obj_type, key))
+        if obj_type not in PAGINATED_OBJECT_TYPES or shown < SHOW_PAGE_SIZE:
+            return concat_shards(obj_type, pages)
+        # The cursor is the name of the last row shown, before any filtering
+        previous_name = last_name
+        (last_name,) = cur.execute(
+            LAST_SHOWN_NAME_QUERY.format(qid=qid, offset=shown - 1)
+        ).fetchone()
+        if last_name == previous_name:
+            # A whole page shares one name (eg overloaded functions): from it, the same page comes back
+            state.print(
+                f"{Fore.RED}More than {SHOW_PAGE_SIZE} {obj_type}s named {last_name} in {container}: "
+                f"paging can't go past them, the {obj_type}s shown after them are left out"
+            )
+            return concat_shards(obj_type, pages)
+
+
+def concat_shards(obj_type: str, frames: list[pd.DataFrame]) -> pd.DataFrame:
+    if not frames:
+        return pd.DataFrame(columns=get_object_columns(obj_type) + ["FULL_NAME"])
+    # Pages can overlap, eg overloaded functions sharing the name the cursor is on
+    return pd.concat(frames, ignore_index=True).drop_duplicates("FULL_NAME")
+
+
+def quote_identifier(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def get_server_time(conn: snowcon.SnowflakeConnection) -> str:
+    """
+    The current time according to Snowflake: objects created after this are picked up by the next delta scan
+    """
+    cur = conn.cursor()
+    (server_time,) = cur.execute(CURRENT_TIMESTAMP_QUERY).fetchone()
+    cur.close()
+    return server_time.isoformat()
+
+
+def show_query(obj_type: str) -> str:
+    return (
+        INTEGRATION_SHOW_QUERY
+        if obj_type.upper().endswith("INTEGRATION")
+        else SHOW_QUERY
+    ).format(obj_type)
+
+
+def show_objects(state: ControlState, cur, obj_type: str) -> str:
+    state.print(f"Executing show query on object type {obj_type}", verbosity_level=4)
+    cur.execute(show_query(obj_type))
+    return cur.sfqid
+
+
+def retrieve_objects(
+    state: ControlState, cur, qid: str, obj_type: str, key: list[str], where=None
+) -> pd.DataFrame:
+    """
+    Retrieve the objects listed by the show query {qid}, optionally only those matching
+    the sql predicate {where}
+    """
+    state.print(f"Retrieving objects of type {obj_type} in account", verbosity_level=3)
+    query = name_query(state, qid, obj_type, key, where=where)
+    return process_objects(state, obj_type, cur.execute(query).fetch_pandas_all())
+
+
+def process_objects(
+    state: ControlState, obj_type: str, panda: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Standardize the full names of the retrieved objects and drop the ignored objects
+    Snowflake couldn't filter out
+    """
+    panda = standardize_full_names(state, obj_type, panda)
+    _, ignore_patterns = split_ignore_patterns(state, obj_type)
+    if not ignore_patterns:
+        return panda
+    ignored = compile_patterns(ignore_patterns, re.IGNORECASE)
+    return panda[~ignored.mask(panda["FULL_NAME"])]
+
+
+def retrieve_live_names(
+    state: ControlState, cur, qid: str, obj_type: str, key: list[str]
+) -> pd.DataFrame:
+    """
+    Retrieve only the name columns of the objects listed by the show query {qid}.
+    RAW_NAME keeps the full name as built in sql, before process_names
+    """
+    state.print(f"Retrieving names of type {obj_type} in account", verbosity_level=3)
+    query = name_query(state, qid, obj_type, key, columns=key)
+    panda = cur.execute(query).fetch_pandas_all()
+    panda["RAW_NAME"] = panda["FULL_NAME"]
+    return standardize_full_names(state, obj_type, panda)
+
+
+def standardize_full_names(
+    state: ControlState, obj_type: str, panda: pd.DataFrame
+) -> pd.DataFrame:
+    if obj_type.lower() in FNCs and not state.normalize_in_sql:
+        panda["FULL_NAME"] = process_names(
+            panda["FULL_NAME"].astype(str).str.replace(" RETURN ", ":", regex=False),
+            obj_type.upper(),
+        )
+    return panda
+
+
+def name_query(
+    state: ControlState,
+    qid: str,
+    obj_type: str,
+    key: list[str],
+    columns: list[str] = None,
+    where: str = None,
+) -> str:
+    """
+    Build the query retrieving the objects listed by the show query {qid}.
+    Only the columns used past the scan are selected (or {columns}), and builtin functions
+    and ignored objects are filtered out by Snowflake rather than in python
+    """
+    columns = columns or get_object_columns(obj_type)
+    full_name = full_name_sql(state, obj_type, key)
+    filters = [
+        IGNORE_OBJECT_FILTER.format(full_name=full_name, pattern=sql_string(p))
+        for p in split_ignore_patterns(state, obj_type)[0]
+    ]
+    if obj_type.lower() in FNCs:
+        filters.append(BUILTIN_FILTER)
+    if where:
+        filters.append(f"({where})")
+    return NAME_QUERY.format(
+        qid=qid,
+        columns=",".join(f'"{column}"' for column in columns),
+        full_name=full_name,
+    ) + "".join(f"and {sql_filter}\n" for sql_filter in filters)
+
+
+def split_ignore_patterns(state: ControlState, obj_type: str) -> Tuple[list, list]:
+    """
+    Split the ignore patterns into those Snowflake can filter on (as RLIKE predicates),
+    and those that have to be matched in python: patterns using python only regex syntax,
+    or all of them when the full name of {obj_type} is only standardized in python
+    """
+    if obj_type.lower() in FNCs and not state.normalize_in_sql:
+        return [], state.ignore_objects
+    in_sql = [p for p in state.ignore_objects if is_posix_compatible(p)]
+    return in_sql, [p for p in state.ignore_objects if not is_posix_compatible(p)]
+
+
+def is_posix_compatible(pattern: str) -> bool:
+    """
+    Snowflake regex is POSIX ERE: no (?...) groups/flags/lookarounds, lazy quantifiers
+    or python's \\b \\A \\Z anchors
+    """
+    return not re.search(r"\(\?|[*+?}]\?|\\[bBAZ]", pattern)
+
+
+def full_name_sql(state: ControlState, obj_type: str, key: list[str]) -> str:
+    """
+    The sql expression building the full name of objects of type {obj_type}. With normalize_in_sql,
+    functions and procedures are standardized by Snowflake instead of process_names
+    """
+    if state.normalize_in_sql and obj_type.lower() in FNCs:
+        return FNC_FULL_NAME_SQL
+    return FULL_NAME_SQL.format(key=",".join([f'"{s}"' for s in key]))
+
+
+def get_cached_objects_of_type(cached: Mapping, obj_type: str) -> pd.DataFrame:
+    """
+    Reassemble the objects of a scanned object type from the cache, where filter_objects
+    may have split them into several object types
+    """
+    frames = [
+        cached[cached_type]
+        for cached_type in cached
+        if obj_type in (cached_type, SPLIT_OBJECT_TYPES.get(cached_type))
+    ]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return pd.DataFrame(columns=["FULL_NAME"])
+    return pd.concat(frames, ignore_index=True).drop_duplicates("FULL_NAME")
+
+
+def sql_string(value: str) -> str:
+    escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
 def filter_objects(
-    state: ControlState, objects: dict[str, pd.DataFrame], method: str
+    state: ControlState, objects: dict[str, pd.DataFrame], ignore_dbs: set = None
 ) -> dict[str, pd.DataFrame]:
-    dbs = objects["database"]
-    # Shared Databases
-    objects["shared database"] = dbs[dbs["kind"] == "IMPORTED DATABASE"].copy()
-    # Application DBs
-    objects["application database"] = dbs[dbs["kind"] == "APPLICATION"].copy()
-    shared_dbs = set(objects["shared database"]["name"])
-    application_dbs = set(objects["application database"]["name"])
-    ignore_dbs = shared_dbs | application_dbs
-
-    # Special Consideration Stage
-    objects["internal stage"] = objects["stage"][
-        objects["stage"]["type"] == "INTERNAL"
-    ].copy()
-    objects["external stage"] = objects["stage"][
-        objects["stage"]["type"] == "EXTERNAL"
-    ].copy()
-
-    # Special Consideration: Information Schema Views
-    objects["view"] = objects["view"][
-        objects["view"]["schema_name"] != "INFORMATION_SCHEMA"
-    ].copy()
-    # Special Consideration: View
-    objects["materialized view"] = objects["view"][
-        objects["view"]["is_materialized"] == "true"
-    ].copy()
-    objects["view"] = objects["view"][
-        objects["view"]["is_materialized"] == "false"
-    ].copy()
+    """
+    Splits off the object types that have their own privileges (see SPLIT_OBJECT_TYPES)
+    and drops objects in shared/application databases or in databases matching IGNORE_DB_PATTERN.
+    Each column is only scanned once, and object types that lose no objects are kept as is.
+    When only some object types were scanned (without databases), the shared/application
+    databases to drop objects from must be passed as {ignore_dbs}
+    """
+    objects = dict(objects)
+
+    # Special Consideration: Shared/Application Databases
+    if "database" in objects:
+        db_kinds = group_by_value(objects["database"], "kind")
+        objects["shared database"] = db_kinds("IMPORTED DATABASE")
+        objects["application database"] = db_kinds("APPLICATION")
+        ignore_dbs = set(objects["shared database"]["name"]) | set(
+            objects["application database"]["name"]
+        )
+
+    # Special Consideration: Stage
+    if "stage" in objects:
+        stage_types = group_by_value(objects["stage"], "type")
+        objects["internal stage"] = stage_types("INTERNAL")
+        objects["external stage"] = stage_types("EXTERNAL")
+
+    # Special Consideration: Information Schema Views, Materialized Views
+    if "view" in objects:
+        views = objects["view"]
+        views = views[views["schema_name"] != "INFORMATION_SCHEMA"]
+        view_kinds = group_by_value(views, "is_materialized")
+        objects["materialized view"] = view_kinds("true")
+        objects["view"] = view_kinds("false")
 
     # Special Consideration: xtab
-    objects["external table"] = objects["table"][
-        objects["table"]["is_external"] == "Y"
-    ].copy()
-    objects["table"] = objects["table"][objects["table"]["is_external"] == "N"].copy()
+    if "table" in objects:
+        table_kinds = group_by_value(objects["table"], "is_external")
+        objects["external table"] = table_kinds("Y")
+        objects["table"] = table_kinds("N")
 
     # Special Consideration: Objects where db/container is a shared/app db
-    if method == "seq":
-        return dict(
-            filter_function(obj_typ, object_df, ignore_dbs)
-            for obj_typ, object_df in objects.items()
-        )
-    else:
-        return {
-            sf_type: df
-            for sf_type, df in state.executor.map(
-                filter_function, *zip(*objects.items()), repeat(ignore_dbs)
-            )
-        }
+    return dict(
+        filter_function(obj_type, obj_df, ignore_dbs or set())
+        for obj_type, obj_df in objects.items()
+    )
+
+
+def group_by_value(obj_df: pd.DataFrame, column: str) -> Callable[[str], pd.DataFrame]:
+    """
+    Splits {obj_df} by the values of {column} in a single pass.
+    Returns a lookup of the rows for a value (no rows for values not present)
+    """
+    groups = dict(tuple(obj_df.groupby(column, sort=False)))
+    return lambda value: groups.get(value, obj_df.iloc[0:0])
 
 
 def filter_function(
     obj_type: str,
     obj_df: pd.DataFrame,
     ignore_dbs: set,
-    ignore_pattern=r".*_(DEV|QA|PROD)_[0-9]{1,5}",
+    ignore_pattern=IGNORE_DB_PATTERN,
 ) -> Tuple[str, pd.DataFrame]:
     identifier = "database_name"
     if obj_type.lower() in FNCs:
@@ -135,33 +599,16 @@ def filter_function(
     ):
         identifier = None
 
-    if identifier:
-        filter = lambda db: db not in ignore_dbs and not re.match(ignore_pattern, db)
-        return obj_type, obj_df[obj_df[identifier].apply(filter)]
-    return obj_type, obj_df
+    if not identifier or obj_df.empty:
+        return obj_type, obj_df
+    # Accounts have few databases compared to objects: only match each database once
+    dbs = obj_df[identifier]
+    ignored_db = compile_patterns([ignore_pattern])
+    ignored = {db for db in dbs.unique() if db in ignore_dbs or ignored_db.matches(db)}
+    if not ignored:
+        return obj_type, obj_df
+    return obj_type, obj_df[~dbs.isin(ignored)]
 
 
 def save_cache(st: ControlState, objects: dict[str, pd.DataFrame]):
-    with open(os.path.join(CONFIG_DIR, "config", st.account, ".snowcache"), "w") as f:
-        f.write(
-            json.dumps(
-                {
-                    "local_cached_time": strftime("%Y-%m-%d %H:%M:%S", localtime()),
-                    "objects": {
-                        # wHy DoNt u UsE to_DiCt, because the stupid to_dict function
-                        # isn't fucking json safe
-                        k: (
-                            json.loads(
-                                df.set_index("FULL_NAME", drop=True).to_json(
-                                    orient="index"
-                                )
-                            )
-                            if not df.empty
-                            else {}
-                        )
-                        for k, df in objects.items()
-                    },
-                },
-                indent=4,
-            )
-        )
+    write_snowcache(st.account, objects, scanned_at=st.scan_times)
@@ -0,0 +1,157 @@
+import threading
+from typing import Callable, Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+# A grant is packed in a uint64 as | privilege (12 bits) | object type (12 bits) | full name (40 bits) |
+NAME_BITS = 40
+TYPE_BITS = 12
+PRIV_BITS = 12
+TYPE_SHIFT = np.uint64(NAME_BITS)
+PRIV_SHIFT = np.uint64(NAME_BITS + TYPE_BITS)
+NAME_MASK = np.uint64((1 << NAME_BITS) - 1)
+TYPE_MASK = np.uint64((1 << TYPE_BITS) - 1)
+NO_GRANTS = np.empty(0, dtype=np.uint64)
+NO_GRANTS.flags.writeable = False
+
+
+class Interner:
+    """
+    Gives each distinct string an id (its position in {values}), ids are never reused
+    """
+
+    def __init__(self, bits: int):
+        self.limit = 1 << bits
+        self.values = []
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def ids(self, values: np.ndarray) -> np.ndarray:
+        codes, uniques = pd.factorize(values)
+        unique_ids = list(map(self._ids.get, uniques))
+        if None in unique_ids:
+            with self._lock:
+                unique_ids = [self._intern(value) for value in uniques]
+        return np.array(unique_ids, dtype=np.uint64)[codes]
+
+    def _intern(self, value: str) -> int:
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            if value_id >= self.limit:
+                raise OverflowError(f"More than {self.limit} distinct values to intern")
+            self._ids[value] = value_id
+            self.values.append(value)
+        return value_id
+
+
+class GrantCodec:
+    """
+    Encodes sets of (privilege, object type, full name) grants as sorted arrays of unique uint64 codes,
+    to compare the grants of roles with hundreds of thousands of them with NumPy set operations
+    instead of sets of string tuples. Codes are only comparable between arrays of the same codec
+    """
+
+    def __init__(self):
+        self.privs = Interner(PRIV_BITS)
+        self.types = Interner(TYPE_BITS)
+        self.names = Interner(NAME_BITS)
+        # Name filter -> whether it keeps each name id, see select()
+        self._kept_names = {}
+
+    def encode(self, grants: Iterable[Tuple[str, str, str]]) -> np.ndarray:
+        grants = pd.DataFrame(list(grants))
+        if grants.empty:
+            return NO_GRANTS
+        privs, types, names = (grants[column].to_numpy() for column in grants)
+        codes = np.unique(
+            (self.privs.ids(privs) << PRIV_SHIFT)
+            | (self.types.ids(types) << TYPE_SHIFT)
+            | self.names.ids(names)
+        )
+        codes.flags.writeable = False
+        return codes
+
+    def decode(self, codes: np.ndarray) -> list:
+        """
+        The grants of {codes}, as a list (without duplicates) of (privilege, object type, full name)
+        """
+        return list(
+            zip(
+                lookup(self.privs, codes >> PRIV_SHIFT),
+                lookup(self.types, (codes >> TYPE_SHIFT) & TYPE_MASK),
+                lookup(self.names, codes & NAME_MASK),
+            )
+        )
+
+    def union(self, encoded: Iterable[np.ndarray]) -> np.ndarray:
+        encoded = [codes for codes in encoded if len(codes)]
+        if not encoded:
+            return NO_GRANTS
+        return np.unique(np.concatenate(encoded))
+
+    def select(
+        self,
+        codes: np.ndarray,
+        keep_name: Callable[[str], bool],
+        keep_kind: Callable[[str, str], bool],
+        name_filter_key=None,
+    ) -> np.ndarray:
+        """
+        The grants of {codes} whose full name passes {keep_name} and (privilege, object type) passes {keep_kind}.
+        Each distinct name/kind is only tested once, and names only once per {name_filter_key}
+        across calls: calls with the same key must pass the same {keep_name}
+        """
+        if not len(codes):
+            return codes
+        names, name_index = np.unique(codes & NAME_MASK, return_inverse=True)
+        kept = (
+            {}
+            if name_filter_key is None
+            else self._kept_names.setdefault(name_filter_key, {})
+        )
+        keep = np.fromiter(
+            (
+                kept[name]
+                if name in kept
+                else kept.setdefault(name, keep_name(self.names.values[name]))
+                for name in names.tolist()
+            ),
+            dtype=bool,
+            count=len(names),
+        )[name_index]
+        kinds, kind_index = np.unique(codes >> TYPE_SHIFT, return_inverse=True)
+        keep &= np.fromiter(
+            (
+                keep_kind(
+                    self.privs.values[kind >> TYPE_BITS],
+                    self.types.values[kind & ((1 << TYPE_BITS) - 1)],
+                )
+                for kind in kinds.tolist()
+            ),
+            dtype=bool,
+            count=len(kinds),
+        )[kind_index]
+        return codes[keep]
+
+
+def lookup(interner: Interner, ids: np.ndarray) -> np.ndarray:
+    unique_ids, index = np.unique(ids, return_inverse=True)
+    values = np.array(
+        [interner.values[value_id] for value_id in unique_ids.tolist()], dtype=object
+    )
+    return values[index]
+
+
+def venn_codes(
+    codes1: np.ndarray, codes2: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    venn() of two arrays of the same GrantCodec
+    """
+    return (
+        np.setdiff1d(codes1, codes2, assume_unique=True),
+        np.intersect1d(codes1, codes2, assume_unique=True),
+        np.setdiff1d(codes2, codes1, assume_unique=True),
+    )
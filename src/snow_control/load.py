@@ -1,56 +1,541 @@
+import hashlib
 import json
 import os
-from typing import Tuple
+import string
+import threading
+import time
+from collections.abc import Mapping
+from contextlib import ExitStack
+from time import localtime, strftime
+from typing import BinaryIO, Iterator, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 import yaml
 from colorama import Fore, Style
+from snow_control.sf_object_structures import DETAILED_OBJECT_TYPE_MAPPER, pluralize
+from snow_control.storage import (
+    account_lock,
+    atomic_write,
+    file_sha256,
+    owned_temporary_path,
+    remove_unreferenced,
+    write_content_addressed,
+)
 
 SCRIPT_DIR = os.path.dirname(__file__)
 CONFIG_DIR = os.environ.get("CONTROL_CONFIG_DIR", SCRIPT_DIR)
+# The C (libyaml) loader parses large config files an order of magnitude faster, when PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def load_yaml(path: str):
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=YAML_LOADER)
+
 
-with open(os.path.join(CONFIG_DIR, "config/atomic_groups.yaml"), "r") as file:
-    ATOMIC_GROUPS = yaml.safe_load(file)
 with open(os.path.join(SCRIPT_DIR, "interactive/intro.txt"), "r") as file:
     CLI_INTRO_TEXT = file.read()
 with open(os.path.join(SCRIPT_DIR, "interactive/menu.txt"), "r") as file:
     CLI_MENU_TEXT = file.read()
 
+# .snowcache is a manifest, the objects of each type live in their own file in SNOWCACHE_DIR
+SNOWCACHE_FORMAT = "feather"
+SNOWCACHE_DIR = ".snowcache.d"
+# Format plan writes .snowplan in: "arrow" (compact) or "jsonl" (readable, 3 to 10+ times bigger). Both can be read back
+SNOWPLAN_FORMAT = os.environ.get("CONTROL_PLAN_FORMAT", "arrow")
+ARROW_STREAM_MARKER = b"\xff\xff\xff\xff"
+PLAN_COMPLETE = "COMPLETE"
+# Each role/user is a run of rows: a first one with its kind, name, fingerprint and ok count,
+# then one per grant. Dictionaries are shared by the whole stream (see PlanBatchBuilder)
+PLAN_SCHEMA = pa.schema(
+    [
+        ("kind", pa.dictionary(pa.int8(), pa.string())),
+        ("name", pa.dictionary(pa.int32(), pa.string())),
+        ("fingerprint", pa.dictionary(pa.int32(), pa.string())),
+        ("delta", pa.dictionary(pa.int8(), pa.string())),
+        ("privilege", pa.dictionary(pa.int16(), pa.string())),
+        ("object_type", pa.dictionary(pa.int16(), pa.string())),
+        ("object_name", pa.dictionary(pa.int32(), pa.string())),
+        ("count", pa.int64()),
+    ]
+)
+# Rows buffered before a record batch is written out. Roles/users are never split across batches
+PLAN_BATCH_ROWS = 2**16
+# The rows a role/user doesn't use (eg its name after the first one) compress away, when pyarrow has zstd
+PLAN_COMPRESSION = "zstd" if pa.Codec.is_available("zstd") else None
+# Bumped whenever CompiledConfig changes, invalidating the .snowconfig of every account
+CONFIG_COMPILER_VERSION = 4
+# Seconds plan uses the snapshot of a role's grants (.snowgrants) for, unless cache_ttl.yaml sets "grants"
+GRANT_SNAPSHOT_TTL = 900
+
 
 def clear_cache(
-    account_name: str, files_to_clear=[".snowcache", ".snowplan", ".snowplansql"]
+    account_name: str,
+    files_to_clear=[
+        ".snowcache",
+        ".snowplan",
+        ".snowplansql",
+        ".snowgrants",
+        ".snowconfig",
+    ],
 ):
-    for file in files_to_clear:
-        open(os.path.join(CONFIG_DIR, f"config/{account_name}/{file}"), "w").close()
+    account_dir = os.path.join(CONFIG_DIR, f"config/{account_name}")
+    cache_dir = os.path.join(account_dir, SNOWCACHE_DIR)
+    with account_lock(account_dir):
+        for file in files_to_clear:
+            with atomic_write(os.path.join(account_dir, file)):
+                pass
+        if ".snowcache" in files_to_clear and os.path.isdir(cache_dir):
+            remove_unreferenced(cache_dir, set(), grace_seconds=0)
 
 
 def get_objects_from_cache(account: str):
+    objects, _ = load_snowcache(account)
+    return objects
+
+
+def load_snowcache(account: str) -> Tuple[Mapping, dict]:
+    """
+    Returns the cached objects along with the (Snowflake) time each object type was last scanned at.
+    The objects of a type are only read once they are looked up (see ObjectRegistry)
+    """
     with open(os.path.join(CONFIG_DIR, f"config/{account}/.snowcache"), "r") as f:
         retrieved = json.loads(f.read())
-        print(
-            f"Retrieving cached record of objects from {Style.BRIGHT + Fore.YELLOW} {retrieved['local_cached_time']} {Style.RESET_ALL} local_time"
-        )
-        return {
+    print(
+        f"Retrieving cached record of objects from {Style.BRIGHT + Fore.YELLOW} {retrieved['local_cached_time']} {Style.RESET_ALL} local_time"
+    )
+    if retrieved.get("format") != SNOWCACHE_FORMAT:
+        # Caches written before the columnar format hold every object inline
+        objects = {
             obj_type: pd.DataFrame(value)
             .T.reset_index()
             .rename({"index": "FULL_NAME"}, axis="columns")
             for obj_type, value in retrieved["objects"].items()
         }
+        return objects, retrieved.get("scanned_at", {})
+    return ObjectRegistry(
+        get_snowcache_dir(account), retrieved["objects"]
+    ), retrieved.get("scanned_at", {})
+
+
+def get_snowcache_dir(account: str) -> str:
+    return os.path.join(CONFIG_DIR, f"config/{account}/{SNOWCACHE_DIR}")
+
+
+def write_snowcache(
+    account: str, objects: dict[str, pd.DataFrame], scanned_at: dict = {}
+):
+    """
+    Writes one uncompressed Feather file per object type (so they can be memory mapped back)
+    and the .snowcache manifest listing them
+    """
+    with account_lock(os.path.join(CONFIG_DIR, f"config/{account}")):
+        entries = write_object_files(account, objects)
+        write_snowcache_manifest(account, entries, scanned_at)
+    return entries
+
+
+def update_snowcache(account: str, objects: dict[str, pd.DataFrame], scanned_at: dict):
+    """
+    Rewrites the files of the object types in {objects} only, and merges them
+    (and their scan times) into the existing manifest. Returns the entries of the rewritten types
+    """
+    with account_lock(os.path.join(CONFIG_DIR, f"config/{account}")):
+        with open(os.path.join(CONFIG_DIR, f"config/{account}/.snowcache"), "r") as f:
+            manifest = json.loads(f.read())
+        entries = write_object_files(account, objects)
+        write_snowcache_manifest(
+            account,
+            manifest["objects"] | entries,
+            manifest.get("scanned_at", {}) | scanned_at,
+        )
+    return entries
+
+
+def write_object_files(account: str, objects: dict[str, pd.DataFrame]) -> dict:
+    """
+    Files are named after their content, so a run still reading the previous manifest
+    never sees them change underneath it
+    """
+    cache_dir = get_snowcache_dir(account)
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = {}
+    for obj_type, df in objects.items():
+        file, sha256 = write_content_addressed(
+            cache_dir,
+            obj_type.replace(" ", "_"),
+            ".feather",
+            lambda path: feather.write_feather(
+                df.reset_index(drop=True), path, compression="uncompressed"
+            ),
+        )
+        entries[obj_type] = {"file": file, "sha256": sha256, "rows": len(df)}
+    return entries
+
+
+def write_snowcache_manifest(account: str, entries: dict, scanned_at: dict):
+    """
+    Must be called holding the account lock. Once the manifest is replaced,
+    object files it no longer lists are garbage collected
+    """
+    cache_dir = get_snowcache_dir(account)
+    with atomic_write(os.path.join(CONFIG_DIR, f"config/{account}/.snowcache")) as f:
+        f.write(
+            json.dumps(
+                {
+                    "format": SNOWCACHE_FORMAT,
+                    "local_cached_time": strftime("%Y-%m-%d %H:%M:%S", localtime()),
+                    "scanned_at": scanned_at,
+                    "objects": entries,
+                },
+                indent=4,
+            )
+        )
+    remove_unreferenced(cache_dir, {entry["file"] for entry in entries.values()})
+
+
+def get_cache_ttls(account: str) -> dict[str, int]:
+    """
+    Reads the optional config/{account}/cache_ttl.yaml: how long the cached objects of each
+    type stay fresh, in seconds or with a unit (eg 90m, 1h, 1d). The "default" entry applies
+    to the object types not listed. Without the file, the cache never goes stale
+    """
+    path = os.path.join(CONFIG_DIR, f"config/{account}/cache_ttl.yaml")
+    if not os.path.exists(path):
+        return {}
+    ttls = load_yaml(path) or {}
+    return {obj_type.lower(): parse_duration(ttl) for obj_type, ttl in ttls.items()}
+
+
+def parse_duration(duration) -> int:
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if isinstance(duration, int):
+        return duration
+    duration = str(duration).strip().lower()
+    if duration[-1] in units:
+        return int(float(duration[:-1]) * units[duration[-1]])
+    return int(duration)
+
+
+class ObjectRegistry(Mapping):
+    """
+    Read-only mapping of object type -> DataFrame of the cached objects of that type.
+    Each type's file is memory mapped and converted the first time it's looked up,
+    so a plan only reads the object types its profiles reference
+    """
+
+    def __init__(self, cache_dir: str, entries: dict[str, dict], loaded: dict = None):
+        self._cache_dir = cache_dir
+        self._entries = entries
+        self._loaded = dict(loaded or {})
+        self._lock = threading.Lock()
+
+    @property
+    def versions(self) -> dict[str, str]:
+        """
+        The sha256 of the cached file of each object type, which changes whenever its objects do
+        """
+        return {
+            obj_type: entry["sha256"]
+            for obj_type, entry in self._entries.items()
+            if "sha256" in entry
+        }
+
+    def updated(
+        self, objects: dict[str, pd.DataFrame], entries: dict[str, dict]
+    ) -> "ObjectRegistry":
+        """
+        The registry once {objects} have been rewritten to the cache as {entries} (see update_snowcache)
+        """
+        loaded = {
+            obj_type: df
+            for obj_type, df in self._loaded.items()
+            if obj_type not in entries
+        }
+        return ObjectRegistry(
+            self._cache_dir, self._entries | entries, loaded | objects
+        )
+
+    def __getitem__(self, obj_type: str) -> pd.DataFrame:
+        if obj_type not in self._loaded:
+            entry = self._entries[obj_type]
+            with self._lock:
+                if obj_type not in self._loaded:
+                    self._loaded[obj_type] = self._read(obj_type, entry)
+        return self._loaded[obj_type]
+
+    def _read(self, obj_type: str, entry: dict) -> pd.DataFrame:
+        path = os.path.join(self._cache_dir, entry["file"])
+        if "sha256" in entry and file_sha256(path) != entry["sha256"]:
+            raise ValueError(
+                f"Cached objects of type {obj_type} don't match their hash, run get again"
+            )
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    def __iter__(self):
+        return iter(self._entries)
 
+    def __len__(self):
+        return len(self._entries)
 
-def get_plan_from_cache(account: str):
-    return json.loads(
-        open(os.path.join(CONFIG_DIR, f"config/{account}/.snowplan"), "r").read()
+
+class GrantSnapshot:
+    """
+    The current and future grants of each role as last retrieved from Snowflake, kept up to date
+    with the grants and revokes apply executes. Plan uses the grants of a role of this snapshot
+    instead of show queries for {ttl} seconds after they were retrieved
+    """
+
+    def __init__(self, roles: dict = None, ttl: int = GRANT_SNAPSHOT_TTL):
+        self.roles = roles or {}
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def get(self, role: str, grant_type: str) -> Optional[set]:
+        """
+        The {grant_type} ("current" or "future") grants of {role}, None if missing or stale
+        """
+        entry = self.roles.get(role.upper(), {}).get(grant_type)
+        if entry is None or time.time() - entry["taken_at"] > self.ttl:
+            return None
+        return set(entry["grants"])
+
+    def put(self, role: str, grant_type: str, grants: set) -> None:
+        with self._lock:
+            self.roles.setdefault(role.upper(), {})[grant_type] = {
+                "taken_at": time.time(),
+                "grants": set(grants),
+            }
+
+    def update(
+        self, role: str, grant_type: str, granted: set = set(), revoked: set = set()
+    ) -> None:
+        """
+        Applies grants/revokes executed since the grants of {role} were retrieved,
+        which doesn't make them any fresher
+        """
+        with self._lock:
+            entry = self.roles.get(role.upper(), {}).get(grant_type)
+            if entry is not None:
+                entry["grants"] = (entry["grants"] - set(revoked)) | set(granted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.roles.clear()
+
+
+def load_grant_snapshot(account: str) -> GrantSnapshot:
+    ttl = get_cache_ttls(account).get("grants", GRANT_SNAPSHOT_TTL)
+    try:
+        with open(os.path.join(CONFIG_DIR, f"config/{account}/.snowgrants"), "r") as f:
+            retrieved = json.loads(f.read())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return GrantSnapshot(ttl=ttl)
+    return GrantSnapshot(
+        {
+            role: {
+                grant_type: {
+                    "taken_at": entry["taken_at"],
+                    "grants": set(map(tuple, entry["grants"])),
+                }
+                for grant_type, entry in role_grants.items()
+            }
+            for role, role_grants in retrieved["roles"].items()
+        },
+        ttl,
     )
 
 
-def get_user_roles_from_config(account: str):
-    return {
-        user: set(roles)
-        for user, roles in yaml.safe_load(
-            open(os.path.join(CONFIG_DIR, f"config/{account}/user_profiles.yaml"), "r")
-        ).items()
+def write_grant_snapshot(account: str, snapshot: GrantSnapshot, replace=False):
+    """
+    Unless {replace}, merges {snapshot} into the .snowgrants of the account,
+    keeping the most recently retrieved grants of each role written by concurrent runs
+    """
+    account_dir = os.path.join(CONFIG_DIR, f"config/{account}")
+    with account_lock(account_dir):
+        roles = {} if replace else load_grant_snapshot(account).roles
+        for role, role_grants in snapshot.roles.items():
+            for grant_type, entry in role_grants.items():
+                stored = roles.setdefault(role, {}).get(grant_type)
+                if stored is None or entry["taken_at"] >= stored["taken_at"]:
+                    roles[role][grant_type] = entry
+        with atomic_write(os.path.join(account_dir, ".snowgrants")) as f:
+            f.write(
+                json.dumps(
+                    {
+                        "roles": {
+                            role: {
+                                grant_type: {
+                                    "taken_at": entry["taken_at"],
+                                    "grants": sorted(entry["grants"]),
+                                }
+                                for grant_type, entry in role_grants.items()
+                            }
+                            for role, role_grants in roles.items()
+                        }
+                    }
+                )
+            )
+
+
+def get_plan_from_cache(account: str) -> dict:
+    """
+    The whole .snowplan in memory: {"plan_id", "ROLES", "USERS", "FINGERPRINTS"}.
+    Prefer iter_plan_from_cache, which only holds one role/user at a time
+    """
+    snowplan = {
+        "plan_id": read_plan_header(account).get("plan_id", -1),
+        "ROLES": {},
+        "USERS": {},
+        "FINGERPRINTS": {},
     }
+    for entry in iter_plan_from_cache(account):
+        snowplan[entry["kind"]][entry["name"]] = entry["plan"]
+        if entry.get("fingerprint"):
+            snowplan["FINGERPRINTS"][entry["name"]] = entry["fingerprint"]
+    return snowplan
+
+
+def get_snowplan_path(account: str) -> str:
+    return os.path.join(CONFIG_DIR, f"config/{account}/.snowplan")
+
+
+def is_arrow_plan(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(ARROW_STREAM_MARKER)) == ARROW_STREAM_MARKER
+
+
+def read_plan_header(account: str) -> dict:
+    path = get_snowplan_path(account)
+    if is_arrow_plan(path):
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_stream(source).schema.metadata
+        return {"plan_id": int(metadata[b"plan_id"])}
+    with open(path, "r") as f:
+        first_line = f.readline()
+    try:
+        return json.loads(first_line)
+    except json.JSONDecodeError:
+        with open(path, "r") as f:
+            return {"plan_id": json.loads(f.read())["plan_id"]}
+
+
+def iter_plan_from_cache(
+    account: str, warn_incomplete=True, lazy=False, with_ok=True
+) -> Iterator[dict]:
+    """
+    Yields the entries of .snowplan one by one: {"kind": "ROLES"/"USERS", "name", "plan", "fingerprint"}.
+    Plans always have an "ok_count", and their "ok" list only {with_ok} and if it was written out (see SnowplanWriter).
+    With {lazy}, entries have a "read_plan" function instead of a "plan", which reads it from the file
+    as it was when iterated, even if it has been replaced since.
+    Warns when the plan was interrupted, in which case only the roles/users planned until then are in it
+    """
+    path = get_snowplan_path(account)
+    if is_arrow_plan(path):
+        complete = yield from iter_arrow_plan(path, lazy, with_ok)
+    else:
+        complete = yield from iter_jsonl_plan(path, lazy, with_ok)
+    if not complete and warn_incomplete:
+        print(
+            f"{Style.BRIGHT + Fore.RED}The plan was interrupted, it only covers the roles and users above{Style.RESET_ALL}"
+        )
+
+
+def iter_jsonl_plan(path: str, lazy: bool, with_ok: bool):
+    """
+    Returns whether the plan is complete once all its entries have been yielded
+    """
+    # Lazy entries read their plan from this file, it's closed once none of them is left
+    f = open(path, "rb")
+    try:
+        first_line = f.readline()
+        if not first_line.strip():
+            return True
+        try:
+            json.loads(first_line)
+        except json.JSONDecodeError:
+            # Plans written before JSON Lines are a single (indented) JSON document
+            for entry in iter_legacy_plan(json.loads(first_line + f.read())):
+                entry["plan"] = with_ok_count(entry["plan"], with_ok)
+                yield entry
+            return True
+        offset = len(first_line)
+        for line in f:
+            entry = json.loads(line)
+            if "complete" in entry:
+                return True
+            if lazy:
+                del entry["plan"]
+                entry["read_plan"] = lambda offset=offset, length=len(line): (
+                    with_ok_count(
+                        json.loads(os.pread(f.fileno(), length, offset))["plan"],
+                        with_ok,
+                    )
+                )
+            else:
+                entry["plan"] = with_ok_count(entry["plan"], with_ok)
+            yield entry
+            offset += len(line)
+        return False
+    finally:
+        if not lazy:
+            f.close()
+
+
+def with_ok_count(plan_for_recipient: dict, with_ok: bool) -> dict:
+    if "ok" in plan_for_recipient:
+        plan_for_recipient["ok_count"] = len(plan_for_recipient["ok"])
+        if not with_ok:
+            del plan_for_recipient["ok"]
+    return plan_for_recipient
+
+
+def iter_legacy_plan(snowplan: dict) -> Iterator[dict]:
+    fingerprints = snowplan.get("FINGERPRINTS", {})
+    for kind in ("ROLES", "USERS"):
+        for name, plan_for_recipient in snowplan[kind].items():
+            yield {
+                "kind": kind,
+                "name": name,
+                "plan": plan_for_recipient,
+                "fingerprint": fingerprints.get(name),
+            }
+
+
+def iter_arrow_plan(path: str, lazy: bool, with_ok: bool):
+    """
+    Returns whether the plan is complete once all its entries have been yielded.
+    The record batches are memory mapped, only the plans asked for are decoded
+    """
+    with pa.memory_map(path) as source:
+        for batch in pa.ipc.open_stream(source):
+            # The plan of a role/user starts on each row with a count
+            starts = np.flatnonzero(
+                batch.column("count").is_valid().to_numpy(zero_copy_only=False)
+            ).tolist()
+            for start, end in zip(starts, starts[1:] + [batch.num_rows]):
+                rows = batch.slice(start, end - start)
+                kind = rows.column("kind")[0].as_py()
+                if kind == PLAN_COMPLETE:
+                    return True
+                entry = {
+                    "kind": kind,
+                    "name": rows.column("name")[0].as_py(),
+                    "fingerprint": rows.column("fingerprint")[0].as_py(),
+                }
+                if lazy:
+                    entry["read_plan"] = lambda rows=rows: batch_to_plan(rows, with_ok)
+                else:
+                    entry["plan"] = batch_to_plan(rows, with_ok)
+                yield entry
+        return False
+
+
+def get_user_roles_from_config(account: str):
+    return load_config(account).users
 
 
 def load_role_configuarations(
@@ -58,72 +543,581 @@ def load_role_configuarations(
 ) -> Tuple[dict, dict]:
     """
     Retrieves account specific role configuration from config files.
-    Optional filter for the configs to only contain the roles in target_roles
+    Optional filter for the configs to only contain the roles in target_roles.
+    The profiles are compiled (see CompiledProfile)
     """
-    with open(os.path.join(CONFIG_DIR, f"config/{account_name}/roles.yaml"), "r") as f:
-        role_configs = yaml.safe_load(f)
-    with open(
-        os.path.join(CONFIG_DIR, f"config/{account_name}/role_profiles.yaml"), "r"
-    ) as f:
-        role_profiles = yaml.safe_load(f)
-    filtered_role_configs = (
-        {role: role_configs[role] for role in target_roles}
-        if target_roles
-        else role_configs
+    config = load_config(account_name)
+    return config.role_configs(target_roles), config.profiles
+
+
+class PatternTemplates:
+    """
+    Object name patterns of a profile, formatted with the parameters a role attaches the profile with
+    (upper case, anchored at the end). Patterns without parameters are only formatted once
+    """
+
+    __slots__ = ("templates", "formatted")
+
+    def __init__(self, templates: list):
+        self.templates = tuple(templates)
+        self.formatted = None
+        if not any(map(has_format_fields, self.templates)):
+            self.formatted = self.format({})
+
+    def format(self, requires: dict) -> list:
+        if self.formatted is not None:
+            return self.formatted
+        return [
+            template.format(**requires).upper() + "$" for template in self.templates
+        ]
+
+
+def has_format_fields(template: str) -> bool:
+    return any(
+        field is not None for _, field, _, _ in string.Formatter().parse(template)
     )
 
-    return filtered_role_configs, role_profiles
 
+class PrivilegeRule:
+    """
+    An atomic group a profile grants on the objects of a type matching {patterns}, expanded to its
+    atomic privileges (upper case, without those in {unsupported_privs}). {future_patterns} match the
+    schemas/databases the future grants of the patterns ending with ".*" are on, as {future_type}
+    """
 
-def write_out_snowplan(
-    account: str, role_snowplan: dict, user_snowplan: dict = {}, plan_id: int = -1
-):
-    with open(os.path.join(CONFIG_DIR, f"config/{account}/.snowplan"), "w") as f:
-        f.write(
-            json.dumps(
-                {
-                    "plan_id": plan_id,
-                    "ROLES": {
-                        role: {
-                            delta_type: list(delta)
-                            for delta_type, delta in plan_for_role.items()
-                        }
-                        for role, plan_for_role in role_snowplan.items()
-                    },
-                    "USERS": {
-                        user: {
-                            delta_type: list(delta)
-                            for delta_type, delta in plan_for_user.items()
-                        }
-                        for user, plan_for_user in user_snowplan.items()
-                    },
-                },
-                indent=2,
+    __slots__ = (
+        "object_type",
+        "grant_type",
+        "privileges",
+        "patterns",
+        "future_type",
+        "future_privileges",
+        "future_patterns",
+    )
+
+    def __init__(
+        self,
+        object_type: str,
+        generic_object_type: str,
+        future_type: str,
+        atomic_privileges: list,
+        objects: list,
+        unsupported_privs: frozenset,
+    ):
+        self.object_type = object_type
+        self.grant_type = generic_object_type.upper()
+        self.privileges = supported(
+            atomic_privileges, self.grant_type, unsupported_privs
+        )
+        self.patterns = PatternTemplates(objects)
+        self.future_type = future_type
+        self.future_privileges = supported(
+            atomic_privileges, future_type, unsupported_privs
+        )
+        # don't use strip() bc multiple
+        self.future_patterns = PatternTemplates(
+            [obj[:-2].rstrip("[.]") for obj in objects if obj.endswith(".*")]
+        )
+
+
+def supported(
+    atomic_privileges: list, grant_type: str, unsupported_privs: frozenset
+) -> tuple:
+    return tuple(
+        priv
+        for priv in (atomic_priv.upper() for atomic_priv in atomic_privileges)
+        if (priv, grant_type) not in unsupported_privs
+    )
+
+
+class CompiledProfile:
+    """
+    A role profile of role_profiles.yaml ({source}) with its atomic groups expanded:
+    a PrivilegeRule per (object type, atomic group), and the account level grants
+    """
+
+    __slots__ = ("source", "object_types", "rules", "account_grants")
+
+    def __init__(
+        self,
+        name: str,
+        source: dict,
+        atomic_groups: dict,
+        unsupported_privs: frozenset,
+    ):
+        self.source = source
+        self.object_types = frozenset(source["privileges"])
+        self.rules = []
+        self.account_grants = ()
+        for object_type, object_privs in source["privileges"].items():
+            if object_type == "role":
+                continue
+            elif object_type == "account":
+                self.account_grants = tuple(
+                    (priv, "ACCOUNT", acct.upper())
+                    for atomic_group, acct in object_privs.items()
+                    for priv in supported(
+                        atomic_group_privileges(
+                            atomic_groups, name, "account", atomic_group
+                        ),
+                        "ACCOUNT",
+                        unsupported_privs,
+                    )
+                )
+                continue
+            generic_object_type = DETAILED_OBJECT_TYPE_MAPPER.get(
+                object_type, object_type
             )
+            future_type = f"FUTURE {pluralize(generic_object_type).upper()} IN {'DATABASE' if object_type.lower() == 'schema' else 'SCHEMA'}"
+            for priv, objects in object_privs.items():
+                atomic_privileges = atomic_group_privileges(
+                    atomic_groups, name, object_type, priv
+                )
+                try:
+                    rule = PrivilegeRule(
+                        object_type,
+                        generic_object_type,
+                        future_type,
+                        atomic_privileges,
+                        objects,
+                        unsupported_privs,
+                    )
+                except ValueError as e:
+                    raise ValueError(
+                        f"Profile {name}: invalid pattern for {priv} on {object_type} ({e})"
+                    ) from e
+                self.rules.append(rule)
+
+
+def atomic_group_privileges(
+    atomic_groups: dict, profile_name: str, object_type: str, atomic_group: str
+) -> list:
+    try:
+        return atomic_groups[object_type][atomic_group]
+    except (KeyError, TypeError):
+        raise ValueError(
+            f"Profile {profile_name}: no atomic group {atomic_group} for {object_type} in atomic_groups.yaml"
+        )
+
+
+class CompiledConfig:
+    """
+    The configuration plan works from, compiled from the yaml files of the account
+    (roles.yaml, role_profiles.yaml, user_profiles.yaml), atomic_groups.yaml and ignore/privs.yaml.
+    Compiling validates that every profile a role attaches exists and every atomic group a profile
+    grants is defined. {sources} is the parsed content of each file (see get_config_sources),
+    which {digest} identifies
+    """
+
+    __slots__ = (
+        "version",
+        "digest",
+        "atomic_groups",
+        "object_types",
+        "roles",
+        "profiles",
+        "users",
+        "unsupported_privs",
+    )
+
+    def __init__(self, digest: str, sources: dict):
+        self.version = CONFIG_COMPILER_VERSION
+        self.digest = digest
+        self.atomic_groups = sources["atomic_groups.yaml"]
+        # Object types plan reads grants on, others (eg new preview objects) are left alone
+        self.object_types = frozenset(self.atomic_groups).union(
+            DETAILED_OBJECT_TYPE_MAPPER.values()
+        )
+        self.unsupported_privs = parse_unsupported_privs(sources["privs.yaml"])
+        self.profiles = {
+            name: CompiledProfile(
+                name,
+                profile,
+                self.atomic_groups,
+                self.unsupported_privs,
+            )
+            for name, profile in sources["role_profiles.yaml"].items()
+        }
+        self.roles = sources["roles.yaml"]
+        for role, role_config in self.roles.items():
+            for assoc_prof in role_config["profiles"]:
+                for profile_name in assoc_prof:
+                    if profile_name not in self.profiles:
+                        raise ValueError(
+                            f"Role {role}: no profile {profile_name} in role_profiles.yaml"
+                        )
+        self.users = {
+            user: set(roles) for user, roles in sources["user_profiles.yaml"].items()
+        }
+
+    def role_configs(self, target_roles: list = None) -> dict:
+        """
+        The configs of {target_roles}, of all roles by default
+        """
+        if not target_roles:
+            return self.roles
+        return {role: self.roles[role] for role in target_roles}
+
+
+def get_config_path(account: str, file: str) -> str:
+    return os.path.join(CONFIG_DIR, f"config/{account}/{file}")
+
+
+def get_config_sources(account: str) -> dict:
+    return {
+        "atomic_groups.yaml": os.path.join(CONFIG_DIR, "config/atomic_groups.yaml"),
+        "privs.yaml": os.path.join(SCRIPT_DIR, "ignore", "privs.yaml"),
+        "roles.yaml": get_config_path(account, "roles.yaml"),
+        "role_profiles.yaml": get_config_path(account, "role_profiles.yaml"),
+        "user_profiles.yaml": get_config_path(account, "user_profiles.yaml"),
+    }
+
+
+def load_config(account: str) -> CompiledConfig:
+    """
+    The CompiledConfig of the account. While the files it's compiled from are unchanged, their parsed
+    content is read back from config/{account}/.snowconfig (JSON) rather than parsed again.
+    Each file is read once: the digest and the compiled config come from the same content
+    """
+    sources = {}
+    for name, source_path in get_config_sources(account).items():
+        with open(source_path, "rb") as f:
+            sources[name] = f.read()
+    digest = hashlib.sha256(
+        json.dumps(
+            [CONFIG_COMPILER_VERSION]
+            + [hashlib.sha256(content).hexdigest() for content in sources.values()]
+        ).encode()
+    ).hexdigest()
+    path = get_config_path(account, ".snowconfig")
+    config = read_config_cache(path, digest)
+    if config is not None:
+        return config
+    parsed = {
+        name: yaml.load(content, Loader=YAML_LOADER)
+        for name, content in sources.items()
+    }
+    config = CompiledConfig(digest, parsed)
+    try:
+        cache = json.dumps(
+            {"version": CONFIG_COMPILER_VERSION, "digest": digest, "sources": parsed}
+        )
+    except (TypeError, ValueError):
+        # Yaml values JSON has no type for (eg dates) aren't cached
+        return config
+    # Nor those it would read back differently (eg integer keys)
+    if json.loads(cache)["sources"] == parsed:
+        with account_lock(os.path.dirname(path)), atomic_write(path) as f:
+            f.write(cache)
+    return config
+
+
+def read_config_cache(path: str, digest: str) -> Optional[CompiledConfig]:
+    """
+    The config compiled from the sources cached in {path} when they are those {digest} identifies.
+    None when they aren't, or the file can't be read or decoded, in which case it's compiled again
+    """
+    try:
+        with open(path, "rb") as f:
+            cache = json.load(f)
+        if cache["version"] != CONFIG_COMPILER_VERSION or cache["digest"] != digest:
+            return None
+        return CompiledConfig(digest, cache["sources"])
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+
+class SnowplanWriter:
+    """
+    Writes a .snowplan as JSON Lines: a header with the plan id, then the plan of each role/user
+    as soon as it's computed, then a footer once the plan is complete.
+    Unless {keep_ok}, only the number of grants that are already in place is written out, not the grants.
+    The file replaces .snowplan when the plan ends, even if it failed: the roles and users planned
+    until then aren't lost (a plan without footer is incomplete, see iter_plan_from_cache).
+    Only meant to be written to by one thread
+    """
+
+    def __init__(self, account: str, plan_id: int = -1, keep_ok=True):
+        self.account_dir = os.path.join(CONFIG_DIR, f"config/{account}")
+        self.plan_id = plan_id
+        self.keep_ok = keep_ok
+        self.counts = {"ROLES": 0, "USERS": 0}
+
+    def __enter__(self) -> "SnowplanWriter":
+        # Keeps the temporary file from being swept while plan is still computing
+        self._owner = ExitStack()
+        self._temp_path = self._owner.enter_context(
+            owned_temporary_path(self.account_dir, ".snowplan")
+        )
+        self._file = open(self._temp_path, "wb")
+        self._start()
+        return self
+
+    def write(self, kind: str, plans: dict, fingerprints: Mapping = {}) -> None:
+        """
+        Appends the plans of {plans} ({recipient: plan}) of {kind} ("ROLES" or "USERS")
+        """
+        for name, plan_for_recipient in plans.items():
+            self._write_plan(kind, name, plan_for_recipient, fingerprints.get(name))
+            self.counts[kind] += 1
+        self._file.flush()
+
+    def __exit__(self, exc_type, exc, traceback):
+        with self._owner:
+            try:
+                self._finish(complete=exc_type is None)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            finally:
+                self._file.close()
+            if exc_type is not None and not any(self.counts.values()):
+                # Nothing worth keeping over the previous plan
+                os.remove(self._temp_path)
+                return
+            with account_lock(self.account_dir):
+                os.replace(self._temp_path, os.path.join(self.account_dir, ".snowplan"))
+
+    def _start(self) -> None:
+        self._write_line({"plan_id": self.plan_id})
+
+    def _write_plan(
+        self, kind: str, name: str, plan_for_recipient: dict, fingerprint: str
+    ) -> None:
+        ok_count = count_ok(plan_for_recipient)
+        plan_for_recipient = {
+            delta_type: delta if delta_type == "ok_count" else list(delta)
+            for delta_type, delta in plan_for_recipient.items()
+            if self.keep_ok or delta_type != "ok"
+        }
+        if "ok" not in plan_for_recipient:
+            plan_for_recipient["ok_count"] = ok_count
+        self._write_line(
+            {
+                "kind": kind,
+                "name": name,
+                "fingerprint": fingerprint,
+                "plan": plan_for_recipient,
+            }
+        )
+
+    def _finish(self, complete: bool) -> None:
+        if complete:
+            self._write_line({"complete": True} | self.counts)
+
+    def _write_line(self, entry: dict) -> None:
+        self._file.write((json.dumps(entry) + "\n").encode())
+
+
+class ArrowSnowplanWriter(SnowplanWriter):
+    """
+    SnowplanWriter writing an Arrow IPC stream of dictionary encoded columns (see PLAN_SCHEMA),
+    that iter_plan_from_cache memory maps. Plans are buffered into record batches of about
+    PLAN_BATCH_ROWS rows, written out as they fill up and when the plan ends
+    """
+
+    def _start(self) -> None:
+        self._stream = pa.ipc.new_stream(
+            self._file,
+            PLAN_SCHEMA.with_metadata({"plan_id": str(self.plan_id)}),
+            options=pa.ipc.IpcWriteOptions(
+                emit_dictionary_deltas=True, compression=PLAN_COMPRESSION
+            ),
         )
+        self._batch = PlanBatchBuilder()
 
+    def _write_plan(
+        self, kind: str, name: str, plan_for_recipient: dict, fingerprint: str
+    ) -> None:
+        self._batch.append(kind, name, fingerprint, plan_for_recipient, self.keep_ok)
+        if len(self._batch) >= PLAN_BATCH_ROWS:
+            self._write_batch()
+
+    def _finish(self, complete: bool) -> None:
+        if complete:
+            self._batch.append(PLAN_COMPLETE, "", None, {}, keep_ok=False)
+        self._write_batch()
+        self._stream.close()
+
+    def _write_batch(self) -> None:
+        if len(self._batch):
+            self._stream.write_batch(self._batch.to_batch())
+            self._batch.clear()
+
+
+def open_snowplan(
+    account: str, plan_id: int = -1, keep_ok=True, format=None
+) -> SnowplanWriter:
+    """
+    A writer of the .snowplan in {format} ("arrow" or "jsonl", SNOWPLAN_FORMAT by default)
+    """
+    writer = (
+        ArrowSnowplanWriter
+        if (format or SNOWPLAN_FORMAT) == "arrow"
+        else SnowplanWriter
+    )
+    return writer(account, plan_id, keep_ok)
+
+
+def count_ok(plan_for_recipient: dict) -> int:
+    if "ok" in plan_for_recipient:
+        return len(plan_for_recipient["ok"])
+    return plan_for_recipient.get("ok_count", 0)
+
+
+class PlanBatchBuilder:
+    """
+    Accumulates the rows of plans (see PLAN_SCHEMA) into record batches.
+    The dictionary of each column only ever grows, so that every batch's is an extension of the
+    previous one's: the stream writes it out once, then each batch adds the values it's the first to use
+    """
+
+    def __init__(self):
+        self.dictionaries = {
+            field.name: {}
+            for field in PLAN_SCHEMA
+            if pa.types.is_dictionary(field.type)
+        }
+        self.clear()
 
-def get_unsupported_privs():
-    with open(os.path.join(SCRIPT_DIR, "ignore", "privs.yaml")) as f:
-        unsupported_privs = [
-            (priv.upper(), target_type.upper())
-            for priv, target_type in yaml.safe_load(f).items()
-            for target_type in target_type
+    def __len__(self) -> int:
+        return len(self.rows["count"])
+
+    def clear(self) -> None:
+        self.rows = {field.name: [] for field in PLAN_SCHEMA}
+
+    def append(
+        self,
+        kind: str,
+        name: str,
+        fingerprint: str,
+        plan_for_recipient: dict,
+        keep_ok: bool,
+    ) -> None:
+        """
+        The first row holds the number of grants already in place, with delta "ok" when
+        those grants are listed among the others rows (grants of each delta), "ok_count" otherwise
+        """
+        keep_ok = keep_ok and "ok" in plan_for_recipient
+        deltas, grants = ["ok" if keep_ok else "ok_count"], [(None, None, None)]
+        for delta_type in ("to_revoke", "ok", "to_grant"):
+            if delta_type == "ok" and not keep_ok:
+                continue
+            delta = list(plan_for_recipient.get(delta_type, ()))
+            deltas += [delta_type] * len(delta)
+            grants += delta
+        privileges, object_types, object_names = zip(*grants)
+        padding = [None] * (len(deltas) - 1)
+        self._encode("kind", [kind] + padding)
+        self._encode("name", [name] + padding)
+        self._encode("fingerprint", [fingerprint] + padding)
+        self._encode("delta", deltas)
+        self._encode("privilege", privileges)
+        self._encode("object_type", object_types)
+        self._encode("object_name", object_names)
+        self.rows["count"] += [count_ok(plan_for_recipient)] + padding
+
+    def _encode(self, column: str, values) -> None:
+        dictionary = self.dictionaries[column]
+        self.rows[column] += [
+            None if value is None else dictionary.setdefault(value, len(dictionary))
+            for value in values
         ]
-    return unsupported_privs
+
+    def to_batch(self) -> pa.RecordBatch:
+        arrays = []
+        for field in PLAN_SCHEMA:
+            if field.name not in self.dictionaries:
+                arrays.append(pa.array(self.rows[field.name], field.type))
+                continue
+            arrays.append(
+                pa.DictionaryArray.from_arrays(
+                    pa.array(self.rows[field.name], field.type.index_type),
+                    pa.array(
+                        list(self.dictionaries[field.name]), field.type.value_type
+                    ),
+                )
+            )
+        return pa.RecordBatch.from_arrays(arrays, schema=PLAN_SCHEMA)
+
+
+def column_values(column: pa.DictionaryArray) -> np.ndarray:
+    """
+    The values of a dictionary encoded column (None for nulls). Only the rows of {column} are decoded,
+    the dictionary is shared by the whole plan
+    """
+    return column.dictionary.take(column.indices).to_numpy(zero_copy_only=False)
+
+
+def batch_to_plan(batch: pa.RecordBatch, with_ok=True) -> dict:
+    deltas = column_values(batch.column("delta"))
+    plan_for_recipient = {
+        "to_revoke": [],
+        "to_grant": [],
+        "ok_count": batch.column("count")[0].as_py(),
+    }
+    if with_ok and deltas[0] == "ok":
+        plan_for_recipient["ok"] = []
+    # The first row only holds the ok count
+    deltas[0] = None
+    wanted = np.isin(deltas, list(plan_for_recipient))
+    if not wanted.any():
+        return plan_for_recipient
+    deltas = deltas[wanted]
+    privileges, object_types, object_names = (
+        column_values(batch.column(column).filter(pa.array(wanted)))
+        for column in ("privilege", "object_type", "object_name")
+    )
+    for delta_type in plan_for_recipient:
+        if delta_type != "ok_count":
+            rows = deltas == delta_type
+            plan_for_recipient[delta_type] = list(
+                zip(privileges[rows], object_types[rows], object_names[rows])
+            )
+    return plan_for_recipient
+
+
+def write_out_snowplan(
+    account: str,
+    role_snowplan: dict,
+    user_snowplan: dict = {},
+    plan_id: int = -1,
+    fingerprints: dict = {},
+):
+    """
+    {fingerprints} are the fingerprints of the inputs each role was planned from (see plan.RoleFingerprints)
+    """
+    with open_snowplan(account, plan_id) as writer:
+        writer.write("ROLES", role_snowplan, fingerprints)
+        writer.write("USERS", user_snowplan)
+
+
+def get_unsupported_privs() -> frozenset:
+    return parse_unsupported_privs(
+        load_yaml(os.path.join(SCRIPT_DIR, "ignore", "privs.yaml"))
+    )
+
+
+def parse_unsupported_privs(privs: dict) -> frozenset:
+    return frozenset(
+        (priv.upper(), target_type.upper())
+        for priv, target_types in privs.items()
+        for target_type in target_types
+    )
 
 
 def get_ignored_object_patterns(account: str):
-    with open(
-        os.path.join(CONFIG_DIR, "config", account, "ignore", "objects.yaml")
-    ) as f:
-        PATTERNS = [
-            f"^{pattern.upper()}$"
-            for pattern in yaml.safe_load(f)["full_name_patterns"]
-        ]
+    PATTERNS = [
+        f"^{pattern.upper()}$"
+        for pattern in load_yaml(
+            os.path.join(CONFIG_DIR, "config", account, "ignore", "objects.yaml")
+        )["full_name_patterns"]
+    ]
     return PATTERNS
 
 
 def write_out_sql_snowplan(account: str, executables: list):
-    with open(os.path.join(CONFIG_DIR, f"config/{account}/.snowplansql"), "w") as f:
+    account_dir = os.path.join(CONFIG_DIR, f"config/{account}")
+    with account_lock(account_dir), atomic_write(
+        os.path.join(account_dir, ".snowplansql")
+    ) as f:
         f.write(";\n".join(executables))
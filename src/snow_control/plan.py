@@ -1,40 +1,55 @@
+import hashlib
+import json
+import os
+import re
+import threading
 import time
-from functools import reduce
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
 from itertools import repeat
-from typing import Tuple
+from typing import Iterable, Iterator, Optional, Tuple
 
+import numpy as np
+from snow_control.async_query import fetch_query_results, wait_for_queries
 from snow_control.control_state import ControlState
-from snow_control.get_objects import object_scan
+from snow_control.get_objects import object_scan, refresh_stale_objects, sql_string
+from snow_control.grant_codec import GrantCodec, venn_codes
 from snow_control.load import (
-    ATOMIC_GROUPS,
-    get_objects_from_cache,
-    get_plan_from_cache,
+    CompiledProfile,
     get_unsupported_privs,
     get_user_roles_from_config,
-    load_role_configuarations,
-    write_out_snowplan,
+    iter_plan_from_cache,
+    load_config,
+    load_grant_snapshot,
+    open_snowplan,
+    write_grant_snapshot,
 )
 from snow_control.queries import (
     CURRENT_GRANTS_TO_ROLE,
     FUTURE_GRANTS_TO_ROLE,
+    GRANTS_TO_ROLES_QUERY,
     GRANTS_TO_USER_QUERY,
+    GRANTS_TO_USERS_QUERY,
     RETRIEVE_GRANTS_TO_USER_QUERY,
 )
 from snow_control.sf_object_structures import (
     DETAILED_OBJECT_TYPE_MAPPER,
+    IndexedObjects,
+    compile_patterns,
     get_futures,
     get_matching,
-    object_matches_any,
     pluralize,
     process_name,
+    show_full_name,
 )
 from snow_control.styling import time_func
 from snowflake.connector.errors import ProgrammingError
 
-ALL_OBJECT_TYPES = set(ATOMIC_GROUPS.keys()).union(
-    set(DETAILED_OBJECT_TYPE_MAPPER.values())
-)
 UNSUPPORTED_PRIVS = get_unsupported_privs()
+# Most show/retrieval queries plan(method="async") keeps running at once
+ASYNC_MAX_IN_FLIGHT = 32
+# Worker processes expanding profiles and diffing roles with plan(method="proc")
+PLAN_PROCESSES = os.cpu_count() or 1
 
 
 @time_func
@@ -45,6 +60,8 @@ def plan(
     from_cache=True,
     method="conc",
     plan_users=False,
+    grant_source="show",
+    keep_ok=True,
 ):
     """
     plan() is the central function that writes out to /{account}/.snowplan
@@ -52,92 +69,584 @@ def plan(
 
     Steps:
         1. Obtain the role configs and profiles
-        2. Connect to SF
+        2. Connect to SF, and refresh the cached object types the profiles use if they went stale
         3. For each role
             a. For each profile granted to each role
                 i. Turn the profile into grants
                 ii. Use venn() to compare the current state with the target state and
                     get a list of privileges to revoek, those that match up , and those to grant
-                iii. Store in a dictionary
-        4. Write out to .snowplan
-        5. Close Connection
+                iii. Write it out to .snowplan (see SnowplanWriter)
+        4. Close Connection
+
+    With grant_source="account_usage", the current grants of all roles are retrieved in one query
+    on SNOWFLAKE.ACCOUNT_USAGE.GRANTS_TO_ROLES instead of a show query per role, and the roles
+    of all users in one query on GRANTS_TO_USERS (see get_current_roles_of_users)
+
+    Roles whose inputs are unchanged since the previous .snowplan (see RoleFingerprints)
+    reuse their previous plan: their current grants are still retrieved, but not diffed again
+
+    The grants of each role are taken from the .snowgrants snapshot while it's fresh (see GrantSnapshot),
+    and retrieved grants are written back to it
+
+    Unless {keep_ok}, only the number of grants already in place is written out (see SnowplanWriter)
     """
     PLAN_ID = int(time.time())
-    user_configs = get_user_roles_from_config(account=account)
-    role_configs, role_profiles = load_role_configuarations(account, roles_to_plan)
+    state.grants = load_grant_snapshot(account)
+    config = state.config = load_config(account)
+    user_configs = config.users
+    role_configs, role_profiles = config.role_configs(roles_to_plan), config.profiles
     objects = (
-        get_objects_from_cache(account) if from_cache else object_scan(state, method)
+        refresh_stale_objects(
+            state, get_profile_object_types(role_configs, role_profiles), method
+        )
+        if from_cache
+        else object_scan(state, method)
+    )
+    fingerprints = RoleFingerprints(
+        state, account, objects, role_profiles, config.atomic_groups
+    )
+    objects = IndexedObjects(objects)
+    expansions = ProfileExpansions()
+    # Future grants aren't in ACCOUNT_USAGE, those are still retrieved role by role
+    current_grants = (
+        get_current_grants_to_roles(state, role_configs)
+        if grant_source == "account_usage"
+        else {}
     )
 
-    role_plan, user_plan = {}, {}
-
-    if method == "seq":
-        for role, config in role_configs.items():
-            role_plan |= plan_single_role(state, objects, role_profiles, role, config)
-        if plan_users:
-            for user, config in user_configs.items():
-                user_plan |= plan_single_user(state, user, config)
+    if method in ("async", "proc"):
+        plan_roles = plan_roles_async if method == "async" else plan_roles_in_processes
+        role_plans = plan_roles(
+            state,
+            objects,
+            role_profiles,
+            role_configs,
+            expansions,
+            current_grants,
+            fingerprints,
+        )
+    elif method == "seq":
+        role_plans = (
+            plan_single_role(
+                state,
+                objects,
+                role_profiles,
+                role,
+                config,
+                expansions,
+                current_grants.get(role.upper()),
+                fingerprints,
+            )
+            for role, config in role_configs.items()
+        )
     else:
-        role_plans, user_plans = [], []
-        role_plans = list(
-            state.executor.map(
+        role_plans = as_completed_results(
+            state.executor.submit(
                 plan_single_role,
-                repeat(state),
-                repeat(objects),
-                repeat(role_profiles),
-                *zip(*role_configs.items()),
+                state,
+                objects,
+                role_profiles,
+                role,
+                config,
+                expansions,
+                current_grants.get(role.upper()),
+                fingerprints,
             )
+            for role, config in role_configs.items()
         )
 
-        if plan_users:
-            user_plans = list(
-                state.executor.map(
-                    plan_single_user, repeat(state), *zip(*user_configs.items())
+    # Each role/user plan is written out as soon as it's computed
+    with open_snowplan(account, plan_id=PLAN_ID, keep_ok=keep_ok) as writer:
+        try:
+            for role_plan in role_plans:
+                writer.write("ROLES", role_plan, fingerprints.computed)
+            if plan_users:
+                if grant_source == "account_usage":
+                    current_roles = get_current_roles_of_users(state, user_configs)
+                    user_plans = (
+                        plan_single_user(state, user, config, current_roles[user])
+                        for user, config in user_configs.items()
+                    )
+                elif method == "seq":
+                    user_plans = (
+                        plan_single_user(state, user, config)
+                        for user, config in user_configs.items()
+                    )
+                else:
+                    user_plans = as_completed_results(
+                        state.executor.submit(plan_single_user, state, user, config)
+                        for user, config in user_configs.items()
+                    )
+                for user_plan in user_plans:
+                    writer.write("USERS", user_plan)
+        finally:
+            write_grant_snapshot(account, state.grants)
+    # log_snowplan(state,account)
+
+
+def as_completed_results(futures: Iterable[Future]) -> Iterator:
+    """
+    The results of {futures} in the order they complete
+    """
+    for future in as_completed(list(futures)):
+        yield future.result()
+
+
+def plan_roles_async(
+    state: ControlState,
+    objects,
+    profiles: dict,
+    role_configs: dict,
+    expansions,
+    current_grants: dict,
+    fingerprints=None,
+) -> Iterator[dict]:
+    """
+    Submits the show (future) grants queries of every role without waiting on them, keeping at most
+    ASYNC_MAX_IN_FLIGHT queries running. As each show query finishes the query retrieving its grants
+    is submitted, and as soon as both grant types of a role are in, the role is diffed on the executor.
+    Roles whose current grants were retrieved beforehand only need their future grants.
+    Yields the plan of each role once it's diffed
+    """
+    conn = state.connection
+    cur = conn.cursor()
+    retrieval_queries = {
+        "current": CURRENT_GRANTS_TO_ROLE,
+        "future": FUTURE_GRANTS_TO_ROLE,
+    }
+    show_queries = {
+        "current": "show grants to role {role}",
+        "future": "show future grants to role {role}",
+    }
+    to_submit = deque()
+    collected = {role: {} for role in role_configs}
+    known = {}
+    for role in role_configs:
+        current = current_grants.get(role.upper())
+        known[role] = {
+            "current": current
+            if current is not None
+            else snapshot_grants(state, role, "current"),
+            "future": snapshot_grants(state, role, "future"),
+        }
+        for grant_type, grants in known[role].items():
+            if grants is None:
+                query = show_queries[grant_type].format(role=role)
+                to_submit.append(((role, grant_type), query))
+            else:
+                collected[role][grant_type] = None
+
+    pending, retrieving, errors, diffs = {}, set(), {}, deque()
+
+    def submit():
+        while to_submit and len(pending) < ASYNC_MAX_IN_FLIGHT:
+            key, query = to_submit.popleft()
+            state.print(f"Submitting {query}", verbosity_level=4)
+            cur.execute_async(query)
+            pending[key] = cur.sfqid
+
+    def fetch_grants(qid: str) -> list:
+        return fetch_query_results(conn, qid) if qid else []
+
+    def diff_collected(role: str, qids: dict) -> dict:
+        normalizers = {
+            "current": normalize_current_grants,
+            "future": normalize_future_grants,
+        }
+        current_state_grants = set()
+        for grant_type, normalize in normalizers.items():
+            grants = known[role][grant_type]
+            if grants is None:
+                grants = normalize(
+                    fetch_grants(qids[grant_type]), state.config.object_types
                 )
+                if qids[grant_type]:
+                    state.grants.put(role, grant_type, grants)
+            current_state_grants |= grants
+        return diff_role(
+            state,
+            objects,
+            profiles,
+            role,
+            role_configs[role],
+            current_state_grants,
+            expansions,
+            fingerprints,
+        )
+
+    # Roles whose grants are all known already don't wait on any query
+    for role in [role for role, qids in collected.items() if len(qids) == 2]:
+        diffs.append(state.executor.submit(diff_collected, role, collected.pop(role)))
+    submit()
+    for key, qid in wait_for_queries(conn, pending, errors):
+        role, grant_type = key
+        if key in errors:
+            # Same as the show query of a role failing in plan_single_role
+            print(str(errors.pop(key)))
+            collected[role][grant_type] = None
+        elif key not in retrieving:
+            retrieving.add(key)
+            # Retrievals go first: they let a role be diffed and free up its results
+            query = retrieval_queries[grant_type].format(qid=qid)
+            to_submit.appendleft((key, query))
+        else:
+            state.print(
+                f"Retrieved {grant_type} grants to role {role}", verbosity_level=3
+            )
+            collected[role][grant_type] = qid
+        if len(collected[role]) == 2:
+            diffs.append(
+                state.executor.submit(diff_collected, role, collected.pop(role))
             )
+        submit()
+        while diffs and diffs[0].done():
+            yield diffs.popleft().result()
 
-        if role_plans:
-            role_plan = reduce(lambda x, y: x | y, role_plans)
+    yield from as_completed_results(diffs)
 
-        if user_plans:
-            user_plan = reduce(lambda x, y: x | y, user_plans, {})
 
-    write_out_snowplan(account, role_plan, user_plan, plan_id=PLAN_ID)
-    # log_snowplan(state,account)
+def plan_roles_in_processes(
+    state: ControlState,
+    objects,
+    profiles: dict,
+    role_configs: dict,
+    expansions,
+    current_grants: dict,
+    fingerprints=None,
+) -> Iterator[dict]:
+    """
+    Retrieves the grants of every role on the executor (waiting on Snowflake), then expands the profiles
+    and diffs the roles on PLAN_PROCESSES worker processes, which aren't held back by the GIL.
+    Each worker is sent the object types the profiles use once, when it starts, and keeps its own
+    memo of profile expansions ({expansions} only serves this process).
+    Roles {fingerprints} has a previous plan for aren't sent to the workers.
+    Yields the plan of each role once it's diffed
+    """
 
+    def retrieve_grants(role: str) -> set:
+        current = current_grants.get(role.upper())
+        if current is None:
+            current = get_current_grants_to_role(state, role)
+        return (current or set()) | (get_future_grants_to_role(state, role) or set())
+
+    grants = dict(zip(role_configs, state.executor.map(retrieve_grants, role_configs)))
+    if fingerprints is not None:
+        for role, role_grants in list(grants.items()):
+            previous = fingerprints.previous_plan(
+                state, role, role_configs[role], role_grants
+            )
+            if previous is not None:
+                yield previous
+                del grants[role]
+    if not grants:
+        return
+    snapshot = {
+        obj_type: objects[obj_type]
+        for obj_type in get_profile_object_types(role_configs, profiles)
+        if obj_type in objects
+    }
+    with ProcessPoolExecutor(
+        max_workers=PLAN_PROCESSES,
+        initializer=init_plan_worker,
+        initargs=(snapshot, profiles, state.ignore_objects, state.verbosity),
+    ) as pool:
+        yield from pool.map(
+            diff_role_in_worker,
+            grants,
+            [role_configs[role] for role in grants],
+            grants.values(),
+            chunksize=max(1, len(grants) // (PLAN_PROCESSES * 4)),
+        )
 
-def plan_single_role(state: ControlState, objects, profiles, role, role_config):
-    target_state_grants = set()
-    shared_databases = set(objects["shared database"]["name"])
-    associated_profiles = role_config["profiles"]
 
-    for assoc_prof in associated_profiles:
-        for profile_name, profile_parameters in assoc_prof.items():
-            profile_config = profiles[profile_name]
-            target_state_grants |= profile_to_grants(
-                state, objects, profile_name, profile_config, **profile_parameters
-            )
-    current_state_grants = get_current_grants_to_role(
-        state, role
-    ) | get_future_grants_to_role(state, role)
+# What each worker process of plan_roles_in_processes diffs roles against
+_plan_worker = {}
+
+
+def init_plan_worker(
+    objects: dict, profiles: dict, ignore_objects: list, verbosity: int
+) -> None:
+    state = ControlState(verbosity=verbosity, max_workers=1)
+    state.ignore_objects = ignore_objects
+    _plan_worker.update(
+        state=state,
+        objects=IndexedObjects(objects),
+        profiles=profiles,
+        expansions=ProfileExpansions(),
+    )
+
+
+def diff_role_in_worker(role: str, role_config: dict, current_state_grants: set):
+    return diff_role(
+        _plan_worker["state"],
+        _plan_worker["objects"],
+        _plan_worker["profiles"],
+        role,
+        role_config,
+        current_state_grants,
+        _plan_worker["expansions"],
+    )
+
+
+def get_profile_object_types(role_configs: dict, role_profiles: dict) -> set:
+    """
+    The object types the profiles of the roles in {role_configs} grant privileges on,
+    along with those every plan looks up (databases, schemas for future grants)
+    """
+    object_types = {"database", "shared database", "schema"}
+    for role_config in role_configs.values():
+        for assoc_prof in role_config["profiles"]:
+            for profile_name in assoc_prof:
+                object_types |= role_profiles[profile_name].object_types
+    return object_types - {"role", "account"}
+
+
+def plan_single_role(
+    state: ControlState,
+    objects,
+    profiles,
+    role,
+    role_config,
+    expansions=None,
+    current_grants: set = None,
+    fingerprints=None,
+):
+    """
+    {current_grants} are the grants retrieved for the role beforehand (see get_current_grants_to_roles),
+    when not given they are retrieved with a show query
+    """
+    if current_grants is None:
+        current_grants = get_current_grants_to_role(state, role)
+    current_state_grants = current_grants | get_future_grants_to_role(state, role)
+    return diff_role(
+        state,
+        objects,
+        profiles,
+        role,
+        role_config,
+        current_state_grants,
+        expansions,
+        fingerprints,
+    )
 
+
+def diff_role(
+    state: ControlState,
+    objects,
+    profiles,
+    role,
+    role_config,
+    current_state_grants: set,
+    expansions=None,
+    fingerprints=None,
+):
+    """
+    Compares the grants the profiles of {role} call for with its {current_state_grants},
+    unless {fingerprints} has a plan of the role computed from the same inputs
+    """
+    if fingerprints is not None:
+        previous = fingerprints.previous_plan(
+            state, role, role_config, current_state_grants
+        )
+        if previous is not None:
+            return previous
     if not current_state_grants:
         return {}
 
-    filter = lambda db: db not in shared_databases
-    current_state_grants = {
-        (priv, typ, full_name)
-        for priv, typ, full_name in current_state_grants
-        if filter(full_name.split(".")[0])
-        and not object_matches_any(full_name, state.ignore_objects)
-        and (priv, typ) not in UNSUPPORTED_PRIVS
+    shared_databases = set(objects["shared database"]["name"])
+    associated_profiles = role_config["profiles"]
+    expansions = expansions or ProfileExpansions()
+    codec = expansions.codec
+
+    target_state_grants = codec.union(
+        expansions.get(state, objects, profile_name, profiles[profile_name], parameters)
+        for assoc_prof in associated_profiles
+        for profile_name, parameters in assoc_prof.items()
+    )
+
+    ignored = compile_patterns(state.ignore_objects, re.IGNORECASE)
+    current_state_grants = codec.select(
+        codec.encode(current_state_grants),
+        keep_name=lambda full_name: full_name.split(".")[0] not in shared_databases
+        and not ignored.matches(full_name),
+        keep_kind=lambda priv, typ: (priv, typ) not in UNSUPPORTED_PRIVS,
+        name_filter_key=(freeze(state.ignore_objects), frozenset(shared_databases)),
+    )
+    revoke, ok, grant = venn_codes(current_state_grants, target_state_grants)
+    return {
+        role: {
+            "to_revoke": codec.decode(revoke),
+            "ok": codec.decode(ok),
+            "to_grant": codec.decode(grant),
+        }
     }
-    revoke, ok, grant = venn(current_state_grants, target_state_grants)
-    return {role: {"to_revoke": revoke, "ok": ok, "to_grant": grant}}
 
 
-def plan_single_user(state: ControlState, user: str, target_state: set):
-    current_state = get_current_users_roles(state, user)
+class RoleFingerprints:
+    """
+    Fingerprints of the inputs of each role's plan: the role config, the profiles it attaches,
+    the versions of the cached object types those profiles use and the role's current grants
+    (along with the ignored objects, atomic groups and unsupported privileges every plan uses).
+    A role whose fingerprint is the one stored in the previous .snowplan gets its previous plan back.
+    Object types whose version isn't known (not read from the cache) are never fingerprinted
+    """
+
+    def __init__(
+        self,
+        state: ControlState,
+        account: str,
+        objects,
+        profiles: dict,
+        atomic_groups: dict,
+    ):
+        self.versions = getattr(objects, "versions", {})
+        self.profiles = profiles
+        self.computed = {}
+        self._shared = hash_json(
+            {
+                "ignore_objects": state.ignore_objects,
+                "atomic_groups": atomic_groups,
+                "unsupported_privs": sorted(UNSUPPORTED_PRIVS),
+            }
+        )
+        # Only the fingerprints of the previous plan are kept in memory, plans are read back when reused
+        try:
+            self._previous = {
+                entry["name"]: entry
+                for entry in iter_plan_from_cache(
+                    account, warn_incomplete=False, lazy=True
+                )
+                if entry["kind"] == "ROLES" and entry.get("fingerprint")
+            }
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._previous = {}
+
+    def fingerprint(
+        self, role: str, role_config: dict, current_state_grants: set
+    ) -> Optional[str]:
+        object_types = get_profile_object_types({role: role_config}, self.profiles)
+        if not object_types <= self.versions.keys():
+            return None
+        return hash_json(
+            {
+                "shared": self._shared,
+                "role": role,
+                "role_config": role_config,
+                "profiles": {
+                    profile_name: self.profiles[profile_name].source
+                    for assoc_prof in role_config["profiles"]
+                    for profile_name in assoc_prof
+                },
+                "objects": {
+                    obj_type: self.versions[obj_type] for obj_type in object_types
+                },
+                "grants": sorted(current_state_grants or ()),
+            }
+        )
+
+    def previous_plan(
+        self, state: ControlState, role: str, role_config: dict, current_state_grants
+    ) -> Optional[dict]:
+        """
+        Records the fingerprint of {role}, and returns its previous plan if that was computed from
+        the same inputs (None otherwise)
+        """
+        fingerprint = self.fingerprint(role, role_config, current_state_grants)
+        if fingerprint is None:
+            return None
+        self.computed[role] = fingerprint
+        previous = self._previous.get(role)
+        if previous is None or previous["fingerprint"] != fingerprint:
+            return None
+        state.print(
+            f"Inputs of role {role} unchanged, reusing its previous plan",
+            verbosity_level=3,
+        )
+        plan_for_role = (
+            previous["read_plan"]() if "read_plan" in previous else previous["plan"]
+        )
+        return {
+            role: {
+                delta_type: delta
+                if delta_type == "ok_count"
+                else [tuple(grant) for grant in delta]
+                for delta_type, delta in plan_for_role.items()
+            }
+        }
+
+
+def hash_json(value) -> str:
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class ProfileExpansions:
+    """
+    Memo of profile_to_grants for a plan run: the roles attaching a profile with the same
+    parameters share one expansion, keyed by (profile name, parameters, objects version).
+    Expansions are kept encoded by {codec} (see GrantCodec).
+    Thread safe: roles asking for an expansion being computed wait on it instead of redoing it
+    """
+
+    def __init__(self, codec: GrantCodec = None):
+        self.codec = codec or GrantCodec()
+        self._expansions = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        state: ControlState,
+        objects,
+        profile_name: str,
+        profile: dict,
+        parameters: dict,
+    ) -> np.ndarray:
+        key = (
+            profile_name,
+            freeze(parameters),
+            getattr(objects, "version", id(objects)),
+        )
+        with self._lock:
+            expansion = self._expansions.get(key)
+            owner = expansion is None
+            if owner:
+                expansion = self._expansions[key] = Future()
+        if owner:
+            try:
+                expansion.set_result(
+                    self.codec.encode(
+                        profile_to_grants(
+                            state, objects, profile_name, profile, **parameters
+                        )
+                    )
+                )
+            except BaseException as e:
+                expansion.set_exception(e)
+                raise
+        return expansion.result()
+
+
+def freeze(value):
+    """
+    Hashable version of profile parameters (nested dicts/lists)
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def plan_single_user(
+    state: ControlState, user: str, target_state: set, current_state: set = None
+):
+    """
+    {current_state} are the roles retrieved for the user beforehand (see get_current_roles_of_users),
+    when not given they are retrieved with a show query
+    """
+    if current_state is None:
+        current_state = get_current_users_roles(state, user)
     to_revoke, ok, to_grant = venn(current_state, target_state)
     return {
         user: {
@@ -149,7 +658,11 @@ def plan_single_user(state: ControlState, user: str, target_state: set):
 
 
 def profile_to_grants(
-    state: ControlState, all_objects: dict, profile_name: str, profile: dict, **requires
+    state: ControlState,
+    all_objects: dict,
+    profile_name: str,
+    profile: CompiledProfile,
+    **requires,
 ) -> set:
     """
     This function converts a role profile (
@@ -161,100 +674,135 @@ def profile_to_grants(
         f"Beginning conversion of profile {profile_name}({','.join(param_string)})",
         verbosity_level=5,
     )
-    grants = []
-    future_grants = []
-    for object_type, object_privs in profile["privileges"].items():
-        generic_object_type = DETAILED_OBJECT_TYPE_MAPPER.get(object_type, object_type)
-        if object_type == "role":
-            continue
-        elif object_type == "account":
-            grants += gen_acct_level_grants(object_privs)
-            continue
-        for priv, objects in object_privs.items():
-            formatted = [obj.format(**requires).upper() + "$" for obj in objects]
-            matched_objects = get_matching(all_objects, object_type, formatted)
-            futures = get_futures(
-                all_objects,
-                object_type,
-                [
-                    obj[:-2].rstrip("[.]").format(**requires).upper()
-                    + "$"  # don't use strip() bc multiple
-                    for obj in objects
-                    if obj.endswith(".*")
-                ],
-            )
-
-            grants += [
-                (
-                    atomic_priv.upper(),
-                    generic_object_type.upper(),
-                    matched_object.upper(),
-                )
-                for atomic_priv in ATOMIC_GROUPS[object_type][priv]
-                for matched_object in matched_objects
-            ]
-            target_future = f"FUTURE {pluralize(generic_object_type).upper()} IN {'DATABASE' if object_type.lower() == 'schema' else 'SCHEMA'}"
-            future_grants += [
-                (atomic_priv.upper(), target_future, f.upper())
-                for atomic_priv in ATOMIC_GROUPS[object_type][priv]
-                for f in futures
-            ]
-    return {
-        grant
-        for grant in set(grants) | set(future_grants)
-        if (grant[0], grant[1]) not in UNSUPPORTED_PRIVS
-    }
+    grants = set(profile.account_grants)
+    for rule in profile.rules:
+        matched_objects = get_matching(
+            all_objects, rule.object_type, rule.patterns.format(requires)
+        )
+        futures = get_futures(
+            all_objects, rule.object_type, rule.future_patterns.format(requires)
+        )
+        grants.update(
+            (atomic_priv, rule.grant_type, matched_object.upper())
+            for atomic_priv in rule.privileges
+            for matched_object in matched_objects
+        )
+        grants.update(
+            (atomic_priv, rule.future_type, f.upper())
+            for atomic_priv in rule.future_privileges
+            for f in futures
+        )
+    return grants
 
 
-def gen_acct_level_grants(account_privilege_profile: dict) -> str:
+def snapshot_grants(state: ControlState, role: str, grant_type: str):
     """
-    account_privilege_profile:{
-        see_all_objects: <acctname>
-    }
+    The {grant_type} grants of {role} in the grant snapshot of the plan, None if not fresh
     """
-    return [
-        (atomic_priv.upper(), "ACCOUNT", acct.upper())
-        for atomic_group, acct in account_privilege_profile.items()
-        for atomic_priv in ATOMIC_GROUPS["account"][atomic_group]
-    ]
+    return state.grants.get(role, grant_type) if state.grants else None
 
 
 def get_current_grants_to_role(state, role):
-    cur = state.connection.cursor()
-    state.print(f"Executing show query on role {role}", verbosity_level=4)
-    try:
-        cur.execute(f"show grants to role {role}")
-    except ProgrammingError as e:
-        print(str(e))
-        return {}
-    qid = cur.sfqid
+    snapshot = snapshot_grants(state, role, "current")
+    if snapshot is not None:
+        return snapshot
+    with state.checkout() as conn:
+        cur = conn.cursor()
+        state.print(f"Executing show query on role {role}", verbosity_level=4)
+        try:
+            cur.execute(f"show grants to role {role}")
+        except ProgrammingError as e:
+            print(str(e))
+            return {}
+        qid = cur.sfqid
+
+        state.print(f"Retrieving current grants to role {role}", verbosity_level=3)
+        results = set(list(cur.execute(CURRENT_GRANTS_TO_ROLE.format(qid=qid))))
+        grants = normalize_current_grants(results, state.config.object_types)
+    if state.grants:
+        state.grants.put(role, "current", grants)
+    return grants
+
+
+def get_current_grants_to_roles(state, roles: Iterable[str]) -> dict[str, set]:
+    """
+    The current grants to all of {roles} in a single query on ACCOUNT_USAGE.GRANTS_TO_ROLES
+    instead of a show query per role, by (upper cased) role name.
+    ACCOUNT_USAGE lags behind by up to 2 hours: very recent grants/revokes aren't in it yet.
+    Roles with fresh grants in the grant snapshot aren't queried
+    """
+    known, grants = {}, {}
+    for role in roles:
+        snapshot = snapshot_grants(state, role, "current")
+        if snapshot is None:
+            grants[role.upper()] = []
+        else:
+            known[role.upper()] = snapshot
+    if not grants:
+        return known
+    state.print(
+        f"Retrieving current grants to {len(grants)} roles from ACCOUNT_USAGE",
+        verbosity_level=3,
+    )
+    query = GRANTS_TO_ROLES_QUERY.format(roles=",".join(map(sql_string, grants)))
+    with state.checkout() as conn:
+        for role, priv, typ, *name_parts in conn.cursor().execute(query):
+            grants[role].append((priv, typ, show_full_name(*name_parts)))
+    retrieved = {
+        role: normalize_current_grants(results, state.config.object_types)
+        for role, results in grants.items()
+    }
+    if state.grants:
+        for role, role_grants in retrieved.items():
+            state.grants.put(role, "current", role_grants)
+    return known | retrieved
+
 
-    state.print(f"Retrieving current grants to role {role}", verbosity_level=3)
-    results = set(list(cur.execute(CURRENT_GRANTS_TO_ROLE.format(qid=qid))))
+def normalize_current_grants(
+    results: Iterable[Tuple[str, str, str]], object_types: frozenset
+) -> set:
+    """
+    (privilege, granted on, name) rows to the (privilege, object type, full name) form of the plan,
+    keeping those on {object_types} (see CompiledConfig)
+    """
     return {
         (
             priv,
             DETAILED_OBJECT_TYPE_MAPPER.get(typ.lower(), typ).upper(),
             process_name(name, typ.upper()),
         )
+        # process_name is memoized: functions granted to many roles are only standardized once
         for priv, typ, name in results
         # Necessary to avoid running into errors with new SF preview objects
-        if typ.lower() in ALL_OBJECT_TYPES
+        if typ.lower() in object_types
     }
 
 
 def get_future_grants_to_role(state, role):
-    cur = state.connection.cursor()
-    state.print(f"Executing show future query on role {role}", verbosity_level=4)
-    try:
-        cur.execute(f"show future grants to role {role}")
-    except ProgrammingError as e:
-        print(str(e))
-        return {}
-    qid = cur.sfqid
-
-    state.print(f"Retrieving future grants to role {role}", verbosity_level=3)
-    results = set(list(cur.execute(FUTURE_GRANTS_TO_ROLE.format(qid=qid))))
+    snapshot = snapshot_grants(state, role, "future")
+    if snapshot is not None:
+        return snapshot
+    with state.checkout() as conn:
+        cur = conn.cursor()
+        state.print(f"Executing show future query on role {role}", verbosity_level=4)
+        try:
+            cur.execute(f"show future grants to role {role}")
+        except ProgrammingError as e:
+            print(str(e))
+            return {}
+        qid = cur.sfqid
+
+        state.print(f"Retrieving future grants to role {role}", verbosity_level=3)
+        results = set(list(cur.execute(FUTURE_GRANTS_TO_ROLE.format(qid=qid))))
+        grants = normalize_future_grants(results, state.config.object_types)
+    if state.grants:
+        state.grants.put(role, "future", grants)
+    return grants
+
+
+def normalize_future_grants(
+    results: Iterable[Tuple[str, str, str]], object_types: frozenset
+) -> set:
     return {
         (
             priv,
@@ -263,7 +811,7 @@ def get_future_grants_to_role(state, role):
         )
         for priv, typ, name in results
         # Necessary to avoid running into errors with new SF preview objects
-        if typ.lower() in ALL_OBJECT_TYPES
+        if typ.lower() in object_types
     }
 
 
@@ -276,18 +824,19 @@ def venn(set1: set, set2: set) -> Tuple[set, set, set]:
 
 
 def get_current_users_roles(state: ControlState, user: str) -> set:
-    cur = state.connection.cursor()
-    state.print(f"Executing show query on user {user}", verbosity_level=4)
-    query = GRANTS_TO_USER_QUERY.format(user=user)
-    cur.execute(query)
-    qid = cur.sfqid
-    state.print(f"Retrieving current grants to user {user}", verbosity_level=3)
-    roles_granted = set(
-        x
-        for (x,) in cur.execute(
-            RETRIEVE_GRANTS_TO_USER_QUERY.format(qid=qid)
-        ).fetchall()
-    )
+    with state.checkout() as conn:
+        cur = conn.cursor()
+        state.print(f"Executing show query on user {user}", verbosity_level=4)
+        query = GRANTS_TO_USER_QUERY.format(user=user)
+        cur.execute(query)
+        qid = cur.sfqid
+        state.print(f"Retrieving current grants to user {user}", verbosity_level=3)
+        roles_granted = set(
+            x
+            for (x,) in cur.execute(
+                RETRIEVE_GRANTS_TO_USER_QUERY.format(qid=qid)
+            ).fetchall()
+        )
 
     # Removes grants not associated with a role from system actions like create WORKSPACE
     # These grants look like: USER$<USER NAME>
@@ -296,13 +845,78 @@ def get_current_users_roles(state: ControlState, user: str) -> set:
     return roles_granted
 
 
+def get_current_roles_of_users(state: ControlState, users: Iterable[str]) -> dict:
+    """
+    The roles granted to each of {users}, retrieved in a single query on ACCOUNT_USAGE.GRANTS_TO_USERS
+    instead of a show query per user. Users that aren't in GRANTS_TO_USERS (it lags behind by up to
+    2 hours, eg users created since) or all users if it can't be queried, are retrieved with show queries
+    """
+    state.print(
+        "Retrieving the roles granted to users from ACCOUNT_USAGE", verbosity_level=3
+    )
+    granted = {}
+    try:
+        with state.checkout() as conn:
+            for user, role in conn.cursor().execute(GRANTS_TO_USERS_QUERY):
+                granted.setdefault(user, set()).add(role)
+    except ProgrammingError as e:
+        print(str(e))
+        granted = {}
+    missing = [user for user in users if user not in granted]
+    if missing:
+        state.print(
+            f"Retrieving the roles granted to {len(missing)} users with show queries",
+            verbosity_level=3,
+        )
+    shown = dict(
+        zip(
+            missing,
+            state.executor.map(
+                lambda user: get_current_users_roles(state, user), missing
+            ),
+        )
+    )
+    # Removes grants not associated with a role from system actions, like get_current_users_roles
+    return {
+        user: shown[user] if user in shown else set(filter(None, granted[user]))
+        for user in users
+    }
+
+
+@time_func
+def refresh_grant_snapshot(state: ControlState, account: str, grant_source="show"):
+    """
+    Retrieves the current and future grants of every role in roles.yaml again,
+    replacing the .snowgrants snapshot plan reads them from
+    """
+    state.config = load_config(account)
+    role_configs = state.config.role_configs()
+    state.grants = load_grant_snapshot(account)
+    state.grants.clear()
+    if grant_source == "account_usage":
+        get_current_grants_to_roles(state, role_configs)
+    list(
+        state.executor.map(
+            lambda role: (
+                get_current_grants_to_role(state, role),
+                get_future_grants_to_role(state, role),
+            ),
+            role_configs,
+        )
+    )
+    write_grant_snapshot(account, state.grants, replace=True)
+
+
 def log_snowplan(state, account):
     pass
 
 
 def print_account_plan(state: ControlState) -> None:
-    plan = get_plan_from_cache(account=state.account)
-    role_plan = plan["ROLES"]
-    user_plan = plan["USERS"]
-    state.print_formatted_plan(role_plan, grants_to="ROLE")
-    state.print_formatted_plan(user_plan, grants_to="USER")
+    """
+    Prints the .snowplan one role/user at a time, roles first
+    """
+    state.print("\n" * 4)
+    for entry in iter_plan_from_cache(state.account, with_ok=False):
+        state.print_formatted_recipient(
+            entry["name"], entry["plan"], grants_to=entry["kind"][:-1]
+        )
@@ -2,10 +2,42 @@ SHOW_QUERY = "show {}s in account"
 
 INTEGRATION_SHOW_QUERY = "show {}s"
 
-NAME_QUERY = """select *, concat_ws('.',{key}) as full_name
+SHARDED_SHOW_QUERY = "show {}s in {scope} {container}"
+
+LAST_SHOWN_NAME_QUERY = (
+    """select "name" from table(result_scan('{qid}')) limit 1 offset {offset}"""
+)
+
+NAME_QUERY = """select {columns}, {full_name} as full_name
 from table(result_scan('{qid}'))
 where "name" not like '%SNOWFLAKE_KAFKA_CONNECTOR%'
-and "name" != 'INFORMATION_SCHEMA' """
+and "name" != 'INFORMATION_SCHEMA'
+"""
+
+BUILTIN_FILTER = """"is_builtin" = 'N'"""
+
+IGNORE_OBJECT_FILTER = "not rlike({full_name}, {pattern}, 'i')"
+
+FULL_NAME_SQL = "concat_ws('.',{key})"
+
+# The standardization of process_name done in sql, for functions/procedures as listed by the
+# show query, ie "arguments" = function_name(arg_type, arg_type, ...) RETURN return_type
+FNC_FULL_NAME_SQL = r"""concat_ws('.',"catalog_name","schema_name",concat(
+    split_part(split_part("arguments",' RETURN ',1),'(',1),'(',
+    regexp_replace(
+        substr(
+            split_part("arguments",' RETURN ',1),
+            position('(',split_part("arguments",' RETURN ',1))+1
+        ),
+        '[^,()]*\\s([^,()\\s]+)','\\1'
+    )
+))"""
+
+CURRENT_TIMESTAMP_QUERY = "select current_timestamp()"
+
+# Show queries don't return when objects were last altered (no "last_altered" column), only created:
+# altered objects are only picked up by a delta get when they were renamed (see incremental_object_scan)
+CREATED_SINCE_FILTER = """"created_on" >= '{since}'::timestamp_ltz"""
 
 
 GRANTS_TO_USER_QUERY = """
@@ -16,6 +48,12 @@ RETRIEVE_GRANTS_TO_USER_QUERY = """
     select "role" from table(result_scan('{qid}'))
 """
 
+# Roles granted to all users at once. ACCOUNT_USAGE lags behind by up to 2 hours
+GRANTS_TO_USERS_QUERY = """
+    select grantee_name, role from snowflake.account_usage.grants_to_users
+    where deleted_on is null
+"""
+
 SET_SEARCH_PATH = """
 alter session set search_path = '$current, $public, snowflake.ml, snowflake.core'
 """
@@ -30,6 +68,24 @@ CURRENT_GRANTS_TO_ROLE = """
     and "name" not like 'SNOWFLAKE%'
 """
 
+# Current grants to many roles at once. ACCOUNT_USAGE lags behind by up to 2 hours.
+# The parts of the names are returned as is, see show_full_name
+GRANTS_TO_ROLES_QUERY = """
+    select grantee_name, privilege, replace(granted_on,'_',' '), table_catalog, table_schema, name from (
+        select grantee_name, privilege, granted_on, table_catalog, table_schema, name,
+        array_to_string(array_construct_compact(table_catalog, table_schema, name), '.') as full_name
+        from snowflake.account_usage.grants_to_roles
+        where deleted_on is null
+        and granted_to = 'ROLE'
+        and grantee_name in ({roles})
+    )
+    where full_name not like '%SNOWFLAKE_KAFKA_CONNECTOR%'
+    and name != 'INFORMATION_SCHEMA'
+    and privilege not in ('OWNERSHIP')
+    and granted_on != 'ROLE'
+    and full_name not like 'SNOWFLAKE%'
+"""
+
 FUTURE_GRANTS_TO_ROLE = """
     select "privilege", replace("grant_on",'_',' '),
     regexp_replace("name" ,'[.][<].*[>]$','') as root_obj
@@ -1,6 +1,11 @@
+import itertools
 import re
-from typing import Iterable
+import threading
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Iterable, Optional
 
+import numpy as np
 import pandas as pd
 
 DETAILED_OBJECT_TYPE_MAPPER = {
@@ -44,6 +49,22 @@ GET_FULL_NAME = (
     | {fnc: FNC_FULL_NAME for fnc in FNCs}
 )
 
+# Columns of the show query used past the scan (eg by filter_objects), besides the full name columns
+OBJECT_COLUMNS = {
+    "database": ["kind"],
+    "table": ["is_external"],
+    "view": ["is_materialized"],
+    "stage": ["type"],
+}
+
+
+def get_object_columns(obj_type: str) -> list[str]:
+    return list(
+        dict.fromkeys(
+            ["name"] + GET_FULL_NAME[obj_type] + OBJECT_COLUMNS.get(obj_type, [])
+        )
+    )
+
 
 def process_name(name: str, obj_type: str) -> str:
     """
@@ -61,6 +82,43 @@ def process_name(name: str, obj_type: str) -> str:
     """
     if obj_type not in ("FUNCTION", "PROCEDURE"):
         return name
+    return standardize_signature(name)
+
+
+def process_names(names: Iterable[str], obj_type: str) -> Iterable[str]:
+    """
+    process_name for a whole column (or any iterable) of names of the same object type.
+    Each distinct name is only standardized once: the same functions are named
+    over and over again across grants to different roles
+    """
+    if obj_type not in ("FUNCTION", "PROCEDURE"):
+        return names
+    if not isinstance(names, pd.Series):
+        return [standardize_signature(name) for name in names]
+    uniques = names.unique()
+    return names.map(dict(zip(uniques, map(standardize_signature, uniques))))
+
+
+# Identifiers show queries print without quotes, others are quoted (with " doubled)
+UNQUOTED_IDENTIFIER = re.compile(r"[A-Z_][A-Z0-9_$]*")
+
+
+def show_full_name(*parts: Optional[str]) -> str:
+    """
+    The full name of an object from its (database, schema, name) parts as stored (eg in ACCOUNT_USAGE),
+    the way show grants queries print it: eg ANALYTICS.MART."Mixed_Case", skipping missing parts
+    """
+    return ".".join(
+        part
+        if UNQUOTED_IDENTIFIER.fullmatch(part)
+        else '"' + part.replace('"', '""') + '"'
+        for part in parts
+        if part
+    )
+
+
+@lru_cache(maxsize=2**16)
+def standardize_signature(name: str) -> str:
     local_name_pattern = r".*[.].*[.](.*[(].*[)][:].*)"
     reg_match = re.match(local_name_pattern, name)
 
@@ -97,7 +155,12 @@ def get_matching(
         else generalized_object_type
     )
 
-    dataframe = objects[object_type].copy()
+    pattern_set = compile_patterns(patterns, re.IGNORECASE)
+    if isinstance(objects, IndexedObjects):
+        # Only the objects under the literal prefix of a pattern can match it
+        dataframe = objects.name_index(object_type).candidates(pattern_set.prefixes)
+    else:
+        dataframe = objects[object_type]
     # Construct the filter clause for the regex match: the constructed full name
     # must match one of the patterns in the atomic group. As such:
     #
@@ -109,8 +172,7 @@ def get_matching(
     # .
     # .
     # re.match('{pattern_n}', full_name)
-    regexp_match = lambda name: object_matches_any(name, patterns)
-    dataframe = dataframe[dataframe["FULL_NAME"].apply(regexp_match)]
+    dataframe = dataframe[pattern_set.mask(dataframe["FULL_NAME"])]
     if object_type == "view":
         dataframe = dataframe[dataframe["schema_name"] != "INFORMATION_SCHEMA"]
     if len(dataframe):
@@ -119,20 +181,214 @@ def get_matching(
 
 
 def object_matches_any(name: str, patterns: list):
-    return any([re.match(pattern, name, re.IGNORECASE) for pattern in patterns])
+    return compile_patterns(patterns, re.IGNORECASE).matches(name)
+
+
+# Numbered/named backreferences would point at the wrong group once patterns are merged
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+class PatternSet:
+    """
+    A list of regex patterns compiled into a single alternation, so a name is matched
+    (re.match style: anchored at the start) against all of them in one pass.
+    Each pattern is its own named group, which tells which pattern matched.
+    Patterns that can't share one regex (eg numbered backreferences, inline flags)
+    are matched one by one instead. Build through compile_patterns, which memoizes them
+    """
+
+    __slots__ = ("patterns", "prefixes", "_regex", "_regexes")
+
+    def __init__(self, patterns: tuple[str, ...], flags=0):
+        self.patterns = patterns
+        self.prefixes = tuple(literal_prefix(pattern) for pattern in patterns)
+        self._regex, self._regexes = None, None
+        if not patterns:
+            return
+        if not any(BACKREFERENCE.search(pattern) for pattern in patterns):
+            try:
+                self._regex = re.compile(
+                    "|".join(
+                        f"(?P<p{i}>{pattern})" for i, pattern in enumerate(patterns)
+                    ),
+                    flags,
+                )
+                return
+            except re.error:
+                pass
+        self._regexes = [re.compile(pattern, flags) for pattern in patterns]
+
+    def match(self, name: str) -> Optional[str]:
+        """
+        The first of the patterns that matches {name}, None if none of them do
+        """
+        if self._regex is not None:
+            matched = self._regex.match(name)
+            return self.patterns[int(matched.lastgroup[1:])] if matched else None
+        for pattern, regex in zip(self.patterns, self._regexes or []):
+            if regex.match(name):
+                return pattern
+        return None
+
+    def matches(self, name: str) -> bool:
+        if self._regex is not None:
+            return self._regex.match(name) is not None
+        return any(regex.match(name) for regex in self._regexes or [])
+
+    def mask(self, names: pd.Series) -> pd.Series:
+        # astype(bool): an empty object series would be taken as a column selection
+        return names.map(self.matches).astype(bool)
+
+
+@lru_cache(maxsize=1024)
+def _compile_patterns(patterns: tuple[str, ...], flags: int) -> PatternSet:
+    return PatternSet(patterns, flags)
+
+
+def compile_patterns(patterns: Iterable[str], flags=0) -> PatternSet:
+    return _compile_patterns(tuple(patterns), flags)
+
+
+REGEX_SPECIAL_CHARACTERS = set(".^$*+?{}[]|()\\")
+
+
+def literal_prefix(pattern: str) -> str:
+    """
+    The literal text every name matching {pattern} (re.match style) starts with, eg
+    ANALYTICS_DEV for ANALYTICS_DEV.MART_.* ("." is a wildcard). Conservative: stops at the
+    first special or non ASCII character, and is empty for patterns with a top level "|"
+    """
+    if has_top_level_alternation(pattern):
+        return ""
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0
+    while i < len(pattern):
+        char, width = pattern[i], 1
+        if char == "\\":
+            char, width = pattern[i + 1 : i + 2], 2
+            # Escaped letters/digits are classes (\d, \w), anchors or backreferences
+            if not char or char.isalnum():
+                break
+        elif char in REGEX_SPECIAL_CHARACTERS:
+            break
+        if not char.isascii():
+            break
+        quantifier = pattern[i + width : i + width + 1]
+        if quantifier in ("*", "?", "{"):
+            break
+        prefix.append(char)
+        if quantifier == "+":
+            break
+        i += width
+    return "".join(prefix)
+
+
+def has_top_level_alternation(pattern: str) -> bool:
+    depth, i, in_class = 0, 0, False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+            # A "]" right after the opening bracket (or its negation) is a literal
+            if pattern[i + 1 : i + 2] == "^":
+                i += 1
+            if pattern[i + 1 : i + 2] == "]":
+                i += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+class NameIndex:
+    """
+    The full names of the objects of one type, upper cased and sorted: the objects whose
+    name starts with a literal prefix (eg a database, or database.schema) are a contiguous
+    slice found by binary search. Names with non ASCII characters could match a prefix
+    case insensitively without sharing its upper case, they are always candidates
+    """
+
+    def __init__(self, objects: pd.DataFrame):
+        names = objects["FULL_NAME"].astype(str)
+        ascii_names = names.map(str.isascii).to_numpy(dtype=bool)
+        # Kept as Python strings: a fixed width array would be as wide as the longest name
+        keys = names.str.upper().to_numpy(dtype=object)[ascii_names]
+        order = np.argsort(keys, kind="stable")
+        self.objects = objects
+        self._keys = keys[order]
+        self._rows = np.flatnonzero(ascii_names)[order]
+        self._always = np.flatnonzero(~ascii_names)
+
+    def candidates(self, prefixes: Iterable[str]) -> pd.DataFrame:
+        """
+        The objects that could match a pattern with one of {prefixes}, all of them if any prefix is empty
+        """
+        prefixes = set(prefixes)
+        if not prefixes or "" in prefixes:
+            return self.objects if "" in prefixes else self.objects.iloc[0:0]
+        ranges = [self._rows[self.prefix_slice(prefix)] for prefix in prefixes]
+        rows = np.unique(np.concatenate(ranges + [self._always]))
+        return self.objects.iloc[rows]
+
+    def prefix_slice(self, prefix: str) -> slice:
+        prefix = prefix.upper()
+        start = np.searchsorted(self._keys, prefix, side="left")
+        end = np.searchsorted(self._keys, prefix + chr(0x10FFFF), side="left")
+        return slice(start, end)
+
+
+class IndexedObjects(Mapping):
+    """
+    Read-only view of a registry of objects (object type -> DataFrame) that builds
+    the NameIndex of an object type the first time get_matching looks it up.
+    Each view gets its own version, which memos of results computed from it are keyed by
+    """
+
+    _versions = itertools.count()
+
+    def __init__(self, objects: Mapping):
+        self.version = next(self._versions)
+        self._objects = objects
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, obj_type: str) -> pd.DataFrame:
+        return self._objects[obj_type]
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def __len__(self):
+        return len(self._objects)
+
+    def name_index(self, obj_type: str) -> NameIndex:
+        if obj_type not in self._indexes:
+            with self._lock:
+                if obj_type not in self._indexes:
+                    self._indexes[obj_type] = NameIndex(self._objects[obj_type])
+        return self._indexes[obj_type]
 
 
 def get_futures(
     objects: dict[str, pd.DataFrame], object_type: str, patterns: Iterable[str]
 ):
-    regexp_match = lambda name: any([re.match(pattern, name) for pattern in patterns])
+    pattern_set = compile_patterns(patterns)
     if object_type.lower() != "schema":
-        dataframe = objects["schema"].copy()
+        dataframe = objects["schema"]
         dataframe = dataframe[dataframe["name"] != "INFORMATION_SCHEMA"]
     else:
-        dataframe = objects["database"].copy()
+        dataframe = objects["database"]
         dataframe = dataframe[dataframe["name"] != "SNOWFLAKE"]
-    dataframe = dataframe[dataframe["FULL_NAME"].apply(regexp_match)]
+    dataframe = dataframe[pattern_set.mask(dataframe["FULL_NAME"])]
     return set(dataframe["FULL_NAME"])
 
 
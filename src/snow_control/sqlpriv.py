@@ -1,32 +1,79 @@
-from snow_control.load import get_plan_from_cache, write_out_sql_snowplan
+from snow_control.load import (
+    get_plan_from_cache,
+    iter_legacy_plan,
+    iter_plan_from_cache,
+    write_out_sql_snowplan,
+)
 
 
-def gen_queries(account: str, snowplan: dict) -> list:
+def gen_queries(account: str, snowplan: dict = None) -> list:
+    """
+    The queries of {snowplan}, read from .snowplan one role/user at a time when not given
+    """
+    return [query for query, _ in gen_plan_queries(account, snowplan)]
+
+
+def gen_plan_queries(account: str, snowplan: dict = None) -> list:
+    """
+    The queries of {snowplan} (see gen_queries), each with the plan entries it executes:
+    [(query, [(kind, role/user, delta type, grant), ...]), ...].
+    The privileges granted to/revoked from a role on the same object are coalesced into one query
+    """
+    entries = (
+        iter_plan_from_cache(account, with_ok=False)
+        if snowplan is None
+        else iter_legacy_plan(snowplan)
+    )
     queries = []
-    for role, config in snowplan["ROLES"].items():
-        role_queries = [
-            gen_grant_to_role(*priv, delta="-", grant_target=role)
-            for priv in config["to_revoke"]
-        ] + [
-            gen_grant_to_role(*priv, delta="+", grant_target=role)
-            for priv in config["to_grant"]
-        ]
-        queries += role_queries
-    for user, config in snowplan["USERS"].items():
-        user_queries = [
-            gen_grant_to_user(*priv, delta="-", grant_target=user)
-            for priv in config["to_revoke"]
-        ] + [
-            gen_grant_to_user(*priv, delta="+", grant_target=user)
-            for priv in config["to_grant"]
-        ]
-        queries += user_queries
+    for entry in entries:
+        for delta_type in ("to_revoke", "to_grant"):
+            plan_entries = [
+                (entry["kind"], entry["name"], delta_type, tuple(priv))
+                for priv in entry["plan"][delta_type]
+            ]
+            if entry["kind"] == "ROLES":
+                queries += [
+                    (gen_entry_query(grouped[0], privileges), grouped)
+                    for privileges, grouped in coalesce_privileges(plan_entries)
+                ]
+            else:
+                queries += [(gen_entry_query(e), [e]) for e in plan_entries]
 
-    executables = [" ".join(q) for q in queries]
+    executables = [" ".join(q) for q, _ in queries]
     write_out_sql_snowplan(account, executables)
     return queries
 
 
+def coalesce_privileges(plan_entries: list) -> list:
+    """
+    Groups the plan entries on the same object, as (comma separated privileges, entries)
+    """
+    on_object = {}
+    for plan_entry in plan_entries:
+        _, object_type, object_name = plan_entry[3]
+        on_object.setdefault((object_type, object_name), []).append(plan_entry)
+    return [
+        (", ".join(plan_entry[3][0] for plan_entry in grouped), grouped)
+        for grouped in on_object.values()
+    ]
+
+
+def gen_entry_query(plan_entry: tuple, privileges: str = None) -> tuple:
+    """
+    The query executing a (kind, role/user, delta type, grant) plan entry,
+    for {privileges} instead of the privilege of the grant if given
+    """
+    kind, grant_target, delta_type, (privilege, object_type, object_name) = plan_entry
+    gen_grant = gen_grant_to_role if kind == "ROLES" else gen_grant_to_user
+    return gen_grant(
+        privileges or privilege,
+        object_type,
+        object_name,
+        delta="-" if delta_type == "to_revoke" else "+",
+        grant_target=grant_target,
+    )
+
+
 def gen_grant_to_role(
     privilege: str, object_type: str, object_name: str, delta: str, grant_target: str
 ):
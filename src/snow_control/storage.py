@@ -0,0 +1,150 @@
+import hashlib
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable
+
+from filelock import FileLock, Timeout
+
+# Seconds a run waits for another run writing to the same account before giving up
+LOCK_TIMEOUT = 600
+# Unreferenced cache files younger than this are kept: a concurrent reader may still need them
+GARBAGE_GRACE_SECONDS = 3600
+TEMP_PREFIX = ".tmp-"
+# A temporary file's writer holds <temporary file><TEMP_LOCK_SUFFIX> while it's running
+TEMP_LOCK_SUFFIX = ".lock"
+
+
+@contextmanager
+def account_lock(account_dir: str):
+    """
+    Serializes the runs writing to the files of an account (config/<account>/).
+    Readers don't take it: files are only ever replaced whole (see atomic_write),
+    so they either see the previous or the next version of a file.
+    Temporary files left behind in the account dir by crashed runs are removed once the lock is taken
+    """
+    with FileLock(os.path.join(account_dir, ".snowcontrol.lock"), timeout=LOCK_TIMEOUT):
+        remove_temporary_files(account_dir)
+        yield
+
+
+@contextmanager
+def atomic_write(path: str, mode="w"):
+    """
+    Opens a temporary file next to {path}, which replaces {path} once it has been fully written.
+    If the write fails (or the process dies), {path} is left untouched
+    """
+    with owned_temporary_path(
+        os.path.dirname(path), os.path.basename(path)
+    ) as temp_path:
+        try:
+            with open(temp_path, mode) as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def write_content_addressed(
+    directory: str, stem: str, suffix: str, write: Callable[[str], None]
+) -> tuple[str, str]:
+    """
+    Calls {write} with a temporary path to write to, then moves the file to
+    {stem}.{hash}{suffix} in {directory}. Returns the file name and its sha256.
+    Files named after their content are never modified, only added and garbage collected
+    """
+    temp_path = temporary_path(directory, stem)
+    try:
+        write(temp_path)
+        digest = file_sha256(temp_path)
+        file = f"{stem}.{digest[:16]}{suffix}"
+        os.replace(temp_path, os.path.join(directory, file))
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return file, digest
+
+
+def temporary_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{TEMP_PREFIX}{uuid.uuid4().hex}-{name}")
+
+
+@contextmanager
+def owned_temporary_path(directory: str, name: str):
+    """
+    A temporary path (see temporary_path) that remove_temporary_files leaves alone until the end
+    of the block, however long the file goes without being written to
+    """
+    path = temporary_path(directory, name)
+    lock = FileLock(path + TEMP_LOCK_SUFFIX)
+    try:
+        with lock:
+            yield path
+    finally:
+        remove_if_exists(lock.lock_file)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove_temporary_files(directory: str, grace_seconds=GARBAGE_GRACE_SECONDS):
+    """
+    Deletes the temporary files of {directory} (see temporary_path) older than {grace_seconds}
+    whose writer is gone: younger ones may still be written by a concurrent run, and so are those
+    whose lock is held (see owned_temporary_path)
+    """
+    cutoff = time.time() - grace_seconds
+    for entry in os.scandir(directory):
+        if not entry.name.startswith(TEMP_PREFIX) or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if entry.name.endswith(TEMP_LOCK_SUFFIX):
+                # Left behind by a run that died between releasing it and removing it
+                if not os.path.exists(entry.path[: -len(TEMP_LOCK_SUFFIX)]):
+                    os.remove(entry.path)
+                continue
+            lock = FileLock(entry.path + TEMP_LOCK_SUFFIX, timeout=0)
+            with lock:
+                os.remove(entry.path)
+            remove_if_exists(lock.lock_file)
+        except Timeout:
+            # Its writer is still running
+            pass
+        except FileNotFoundError:
+            # Replaced or removed by the run that wrote it in the meantime
+            pass
+
+
+def remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_unreferenced(
+    directory: str, referenced: set, grace_seconds=GARBAGE_GRACE_SECONDS
+):
+    """
+    Deletes the files of {directory} that aren't in {referenced} (including temporary
+    files left behind by crashed runs), once they are older than {grace_seconds}
+    """
+    cutoff = time.time() - grace_seconds
+    for entry in os.scandir(directory):
+        if entry.name in referenced or not entry.is_file():
+            continue
+        if entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+import pytest
+import yaml
+
+# Keeps the tests away from the config of the checkout (see the account fixture)
+os.environ["CONTROL_CONFIG_DIR"] = tempfile.mkdtemp(prefix="snow_control_tests-")
+# Read by snow_control.styling at import time
+os.environ.setdefault("SNOWFLAKE_ORGANIZATION", "test_org")
+
+ATOMIC_GROUPS = {
+    "database": {"read": ["USAGE"]},
+    "schema": {"read": ["USAGE"]},
+    "table": {"read": ["SELECT"], "write": ["SELECT", "INSERT", "UPDATE"]},
+    "warehouse": {"use": ["USAGE"]},
+    "function": {"use": ["USAGE"]},
+    "account": {"see_all": ["MONITOR USAGE"]},
+}
+ROLE_PROFILES = {
+    "reader": {
+        "privileges": {
+            "database": {"read": ["ANALYTICS_{env}"]},
+            "table": {"read": ["ANALYTICS_{env}.MART_.*"]},
+        }
+    },
+    "writer": {"privileges": {"table": {"write": ["ANALYTICS_{env}.MART_A.*"]}}},
+    "whuser": {
+        "privileges": {"warehouse": {"use": ["WH_.*"]}, "account": {"see_all": "acct"}}
+    },
+}
+ROLES = {
+    "analyst": {"profiles": [{"reader": {"env": "DEV"}}, {"whuser": {}}]},
+    "engineer": {"profiles": [{"reader": {"env": "DEV"}}, {"writer": {"env": "DEV"}}]},
+}
+USER_PROFILES = {"alice": ["analyst"], "bob": ["engineer", "analyst"]}
+
+
+def write_yaml(path: str, content) -> None:
+    with open(path, "w") as f:
+        yaml.safe_dump(content, f)
+
+
+@pytest.fixture
+def account(tmp_path, monkeypatch):
+    """
+    An account "acct" with the config above, in a config dir of its own
+    """
+    from snow_control import load
+
+    account_dir = tmp_path / "config" / "acct"
+    account_dir.mkdir(parents=True)
+    write_yaml(tmp_path / "config" / "atomic_groups.yaml", ATOMIC_GROUPS)
+    write_yaml(account_dir / "role_profiles.yaml", ROLE_PROFILES)
+    write_yaml(account_dir / "roles.yaml", ROLES)
+    write_yaml(account_dir / "user_profiles.yaml", USER_PROFILES)
+    monkeypatch.setattr(load, "CONFIG_DIR", str(tmp_path))
+    return "acct"
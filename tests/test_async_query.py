@@ -0,0 +1,36 @@
+from snow_control import async_query
+
+
+class ResultCursor:
+    """
+    A cursor holding the results of finished queries, that fails any query it's asked to run
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.rows = None
+
+    def execute(self, query):
+        raise AssertionError(f"Ran {query}")
+
+    def query_result(self, qid):
+        self.rows = self.results[qid]
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+class ResultConnection:
+    def __init__(self, results):
+        self.results = results
+
+    def cursor(self):
+        return ResultCursor(self.results)
+
+
+def test_results_are_fetched_without_running_a_query():
+    conn = ResultConnection({"qid": [("USAGE", "DATABASE", "ANALYTICS")]})
+    assert async_query.fetch_query_results(conn, "qid") == [
+        ("USAGE", "DATABASE", "ANALYTICS")
+    ]
@@ -0,0 +1,156 @@
+import queue
+import threading
+
+import pytest
+from snow_control import connection_pool
+from snow_control.connection_pool import ConnectionPool
+from snowflake.connector.errors import Error
+
+
+class StubConnection:
+    """
+    Stands in for a SnowflakeConnection: records its queries, which fail once it's {dead}
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.dead = False
+        self.queries = []
+        self.setups = 0
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        if self.dead:
+            raise Error("Connection is gone")
+        self.queries.append(query)
+        return self
+
+
+class Connector:
+    def __init__(self):
+        self.opened = []
+
+    def __call__(self):
+        conn = StubConnection()
+        self.opened.append(conn)
+        return conn
+
+
+def setup(conn):
+    conn.setups += 1
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(connection_pool.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_checked_in_connections_are_reused():
+    connect = Connector()
+    pool = ConnectionPool(connect, size=2, setup=setup)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        assert second is first
+    assert connect.opened == [first]
+
+
+def test_opens_up_to_size_connections_at_once():
+    connect = Connector()
+    pool = ConnectionPool(connect, size=2, setup=setup)
+    first, second = pool.checkout(), pool.checkout()
+    assert first is not second
+    assert len(connect.opened) == 2
+
+
+def test_health_check_only_after_idling(clock):
+    pool = ConnectionPool(Connector(), size=1)
+    with pool.connection() as conn:
+        pass
+    clock[0] += connection_pool.HEALTH_CHECK_AFTER_SECONDS - 1
+    assert pool.checkout() is conn
+    assert conn.queries == []
+    pool.checkin(conn)
+    clock[0] += connection_pool.HEALTH_CHECK_AFTER_SECONDS + 1
+    assert pool.checkout() is conn
+    assert conn.queries == [connection_pool.HEALTH_CHECK_QUERY]
+
+
+def test_dead_connection_is_replaced(clock):
+    connect = Connector()
+    pool = ConnectionPool(connect, size=1, setup=setup)
+    with pool.connection() as dead:
+        pass
+    dead.dead = True
+    clock[0] += connection_pool.HEALTH_CHECK_AFTER_SECONDS + 1
+    with pool.connection() as conn:
+        assert conn is not dead
+    assert dead.closed
+    assert connect.opened == [dead, conn]
+
+
+def test_closed_connection_is_not_checked_back_in():
+    connect = Connector()
+    pool = ConnectionPool(connect, size=1)
+    with pool.connection() as closed:
+        closed.close()
+    with pool.connection() as conn:
+        assert conn is not closed
+    assert len(connect.opened) == 2
+
+
+def test_setup_runs_once_per_new_connection(clock):
+    login = StubConnection()
+    connect = Connector()
+    pool = ConnectionPool(connect, size=3, setup=setup, connections=[login])
+    first, second = pool.checkout(), pool.checkout()
+    for conn in (first, second):
+        pool.checkin(conn)
+    for _ in range(3):
+        with pool.connection():
+            pass
+    # The connections handed over are set up already
+    assert login.setups == 0
+    assert [conn.setups for conn in connect.opened] == [1]
+    connect.opened[0].dead = True
+    clock[0] += connection_pool.HEALTH_CHECK_AFTER_SECONDS + 1
+    pool.checkout(), pool.checkout()
+    assert [conn.setups for conn in connect.opened] == [1, 1]
+
+
+def test_exhausted_pool_waits_for_a_checkin():
+    pool = ConnectionPool(Connector(), size=1)
+    conn = pool.checkout()
+    with pytest.raises(queue.Empty):
+        pool.checkout(timeout=0.05)
+    waiting = []
+    waiter = threading.Thread(target=lambda: waiting.append(pool.checkout(timeout=5)))
+    waiter.start()
+    pool.checkin(conn)
+    waiter.join()
+    assert waiting == [conn]
+
+
+def test_failed_connect_frees_its_slot():
+    attempts = []
+
+    def connect():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise Error("Login failed")
+        return StubConnection()
+
+    pool = ConnectionPool(connect, size=1)
+    with pytest.raises(Error):
+        pool.checkout(timeout=0.05)
+    assert isinstance(pool.checkout(timeout=0.05), StubConnection)
@@ -0,0 +1,45 @@
+import pandas as pd
+from snow_control import get_objects
+from snow_control.control_state import ControlState
+
+
+class PageCursor:
+    """
+    A cursor whose show queries always return a full page of tables all named T
+    """
+
+    sfqid = "qid"
+    rowcount = get_objects.SHOW_PAGE_SIZE
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+        return self
+
+    def fetchone(self):
+        return ("T",)
+
+
+class PageConnection:
+    def __init__(self):
+        self.cur = PageCursor()
+
+    def cursor(self):
+        return self.cur
+
+
+def test_paged_show_stops_when_the_cursor_does_not_advance(monkeypatch):
+    monkeypatch.setattr(
+        get_objects,
+        "retrieve_objects",
+        lambda *args, **kwargs: pd.DataFrame({"FULL_NAME": ["DB.S.T"]}),
+    )
+    conn = PageConnection()
+    shown = get_objects.paged_show(
+        ControlState(verbosity=0), conn, "table", "database", '"DB"'
+    )
+    assert list(shown["FULL_NAME"]) == ["DB.S.T"]
+    show_queries = [q for q in conn.cur.queries if q.startswith("show")]
+    assert len(show_queries) == 2
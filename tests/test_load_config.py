@@ -0,0 +1,102 @@
+import copy
+import json
+import os
+
+import pytest
+from snow_control import load
+
+from tests.conftest import ATOMIC_GROUPS, ROLE_PROFILES, ROLES, write_yaml
+
+
+def rules(config, profile_name):
+    return [
+        (rule.object_type, rule.privileges, rule.patterns.templates)
+        for rule in config.profiles[profile_name].rules
+    ]
+
+
+def test_compiles_profiles(account):
+    config = load.load_config(account)
+    assert rules(config, "writer") == [
+        ("table", ("SELECT", "INSERT", "UPDATE"), ("ANALYTICS_{env}.MART_A.*",))
+    ]
+    assert config.profiles["whuser"].account_grants == (
+        ("MONITOR USAGE", "ACCOUNT", "ACCT"),
+    )
+    assert config.users["bob"] == {"engineer", "analyst"}
+    assert isinstance(config.unsupported_privs, frozenset)
+
+
+def test_pattern_templates():
+    assert load.PatternTemplates(["WH_.*"]).format({}) == ["WH_.*$"]
+    templates = load.PatternTemplates(["analytics_{env}.mart_.*"])
+    assert templates.formatted is None
+    assert templates.format({"env": "dev"}) == ["ANALYTICS_DEV.MART_.*$"]
+
+
+def test_reuses_cache_while_sources_unchanged(account):
+    config = load.load_config(account)
+    cached = os.stat(load.get_config_path(account, ".snowconfig"))
+    assert load.load_config(account).digest == config.digest
+    # Compiling again would have replaced .snowconfig
+    reused = os.stat(load.get_config_path(account, ".snowconfig"))
+    assert (reused.st_ino, reused.st_mtime_ns) == (cached.st_ino, cached.st_mtime_ns)
+
+
+@pytest.mark.parametrize("edit", ["atomic_groups", "role_profiles"])
+def test_recompiles_when_a_source_changes(account, edit):
+    before = load.load_config(account)
+    if edit == "atomic_groups":
+        atomic_groups = copy.deepcopy(ATOMIC_GROUPS)
+        atomic_groups["table"]["write"] = ["SELECT", "DELETE"]
+        write_yaml(
+            os.path.join(load.CONFIG_DIR, "config/atomic_groups.yaml"), atomic_groups
+        )
+    else:
+        profiles = copy.deepcopy(ROLE_PROFILES)
+        profiles["writer"]["privileges"]["table"]["write"] = [
+            "ANALYTICS_{env}.MART_B.*"
+        ]
+        write_yaml(load.get_config_path(account, "role_profiles.yaml"), profiles)
+    after = load.load_config(account)
+    assert after.digest != before.digest
+    assert rules(after, "writer") != rules(before, "writer")
+    # The recompiled config is what the next session reads back
+    assert rules(load.load_config(account), "writer") == rules(after, "writer")
+
+
+def test_unknown_profile(account):
+    roles = copy.deepcopy(ROLES)
+    roles["analyst"]["profiles"].append({"missing": {}})
+    write_yaml(load.get_config_path(account, "roles.yaml"), roles)
+    with pytest.raises(ValueError, match="no profile missing"):
+        load.load_config(account)
+
+
+def test_unknown_atomic_group(account):
+    profiles = copy.deepcopy(ROLE_PROFILES)
+    profiles["reader"]["privileges"]["table"]["own"] = ["X.*"]
+    write_yaml(load.get_config_path(account, "role_profiles.yaml"), profiles)
+    with pytest.raises(ValueError, match="no atomic group own for table"):
+        load.load_config(account)
+
+
+def test_malformed_pattern(account):
+    profiles = copy.deepcopy(ROLE_PROFILES)
+    profiles["reader"]["privileges"]["table"]["read"] = ["ANALYTICS_{env.*"]
+    write_yaml(load.get_config_path(account, "role_profiles.yaml"), profiles)
+    with pytest.raises(ValueError, match="invalid pattern for read on table"):
+        load.load_config(account)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [b"", b"\x80\x05garbage", b'{"version": 4, "digest"', b"[]", b'{"sources": 1}'],
+)
+def test_undecodable_cache_is_compiled_again(account, content):
+    config = load.load_config(account)
+    with open(load.get_config_path(account, ".snowconfig"), "wb") as f:
+        f.write(content)
+    assert rules(load.load_config(account), "writer") == rules(config, "writer")
+    with open(load.get_config_path(account, ".snowconfig")) as f:
+        assert json.load(f)["digest"] == config.digest
@@ -0,0 +1,66 @@
+import os
+
+from snow_control import load, plan
+from snow_control.control_state import ControlState
+
+from tests.conftest import ATOMIC_GROUPS, write_yaml
+
+# (privilege, granted on, name as show grants prints it, name parts as ACCOUNT_USAGE stores them)
+GRANTS = [
+    ("USAGE", "DATABASE", "ANALYTICS", (None, None, "ANALYTICS")),
+    ("USAGE", "SCHEMA", 'ANALYTICS."raw"', ("ANALYTICS", None, "raw")),
+    ("SELECT", "TABLE", 'ANALYTICS.MART."Orders"', ("ANALYTICS", "MART", "Orders")),
+    ("SELECT", "VIEW", "ANALYTICS.MART.V_1$", ("ANALYTICS", "MART", "V_1$")),
+    ("SELECT", "TABLE", '"my db".MART."a""b"', ("my db", "MART", 'a"b')),
+    (
+        "USAGE",
+        "FUNCTION",
+        'ANALYTICS."Mart"."ADD_ONE(X NUMBER):NUMBER(38,0)"',
+        ("ANALYTICS", "Mart", "ADD_ONE(X NUMBER):NUMBER(38,0)"),
+    ),
+    ("USAGE", "WAREHOUSE", "WH_1", (None, None, "WH_1")),
+]
+
+
+class GrantsCursor:
+    sfqid = "qid"
+
+    def execute(self, query):
+        if "account_usage.grants_to_roles" in query:
+            return [("ANALYST", priv, typ, *parts) for priv, typ, _, parts in GRANTS]
+        if "result_scan" in query:
+            return [(priv, typ, name) for priv, typ, name, _ in GRANTS]
+        return []
+
+
+class GrantsConnection:
+    def cursor(self):
+        return GrantsCursor()
+
+
+def test_account_usage_grants_match_show_grants(account):
+    state = ControlState(verbosity=0)
+    state.config = load.load_config(account)
+    state.connection = GrantsConnection()
+    shown = plan.get_current_grants_to_role(state, "analyst")
+    assert len(shown) == len(GRANTS)
+    assert plan.get_current_grants_to_roles(state, ["analyst"]) == {"ANALYST": shown}
+
+
+def test_show_full_name():
+    assert plan.show_full_name(None, None, "WH_1") == "WH_1"
+    assert plan.show_full_name("DB", "sch", 'a"b') == 'DB."sch"."a""b"'
+
+
+def test_grants_are_read_on_the_object_types_of_the_config(account):
+    grants = [("MONITOR", "PIPE", "ANALYTICS.MART.LOAD")]
+    config = load.load_config(account)
+    assert plan.normalize_current_grants(grants, config.object_types) == set()
+    atomic_groups = dict(ATOMIC_GROUPS, pipe={"monitor": ["MONITOR"]})
+    write_yaml(
+        os.path.join(load.CONFIG_DIR, "config/atomic_groups.yaml"), atomic_groups
+    )
+    config = load.load_config(account)
+    assert plan.normalize_current_grants(grants, config.object_types) == {
+        ("MONITOR", "PIPE", "ANALYTICS.MART.LOAD")
+    }
@@ -0,0 +1,23 @@
+import pandas as pd
+from snow_control.sf_object_structures import NameIndex
+
+
+def test_name_index_candidates():
+    names = [
+        "DB.S.T1",
+        "db.s.t2",
+        "DB.SX.T3",
+        "DB2.S.T4",
+        "DB.S.TÉ",
+        "DB.S." + "X" * 10_000,
+    ]
+    index = NameIndex(pd.DataFrame({"FULL_NAME": names}))
+    assert index._keys.dtype == object
+    assert list(index.candidates(["DB.S."])["FULL_NAME"]) == [
+        "DB.S.T1",
+        "db.s.t2",
+        "DB.S.TÉ",
+        "DB.S." + "X" * 10_000,
+    ]
+    assert list(index.candidates(["DB2."])["FULL_NAME"]) == ["DB2.S.T4", "DB.S.TÉ"]
+    assert len(index.candidates([""])) == len(names)
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+from snow_control import load
+
+
+def role_plans(roles: int, grants: int) -> dict:
+    """
+    Plans of {roles} roles, granted {grants} of the same tables each
+    """
+    tables = [("SELECT", "TABLE", f'ANALYTICS.MART."Table_{i}"') for i in range(grants)]
+    return {
+        f"ROLE_{role}": {
+            "to_revoke": tables[: role % 3],
+            "ok": tables[role % 3 : grants // 2],
+            "to_grant": tables[grants // 2 :],
+        }
+        for role in range(roles)
+    }
+
+
+def write_plan(account, plans, format, keep_ok=True):
+    with load.open_snowplan(account, 7, keep_ok=keep_ok, format=format) as writer:
+        writer.write("ROLES", plans, {role: role.lower() for role in plans})
+        writer.write("USERS", {"ALICE": {"to_grant": [], "to_revoke": []}})
+    return os.path.getsize(load.get_snowplan_path(account))
+
+
+@pytest.mark.parametrize("format", ["arrow", "jsonl"])
+@pytest.mark.parametrize("keep_ok", [True, False])
+def test_plan_round_trip(account, monkeypatch, format, keep_ok):
+    # Roles end up spread over several record batches
+    monkeypatch.setattr(load, "PLAN_BATCH_ROWS", 5)
+    plans = role_plans(10, 8)
+    write_plan(account, plans, format, keep_ok)
+    assert load.read_plan_header(account) == {"plan_id": 7}
+    entries = list(load.iter_plan_from_cache(account, lazy=True))
+    assert [entry["name"] for entry in entries] == list(plans) + ["ALICE"]
+    for entry in entries[:-1]:
+        plan_for_recipient = entry["read_plan"]()
+        expected = plans[entry["name"]]
+        assert entry["fingerprint"] == entry["name"].lower()
+        assert plan_for_recipient["ok_count"] == len(expected["ok"])
+        for delta_type in ("to_revoke", "to_grant") + (("ok",) if keep_ok else ()):
+            assert list(map(tuple, plan_for_recipient[delta_type])) == list(
+                expected[delta_type]
+            )
+        assert keep_ok or "ok" not in plan_for_recipient
+    assert entries[-1]["kind"] == "USERS"
+
+
+@pytest.mark.parametrize("format", ["arrow", "jsonl"])
+def test_interrupted_plan_keeps_planned_roles(account, format, capsys):
+    plans = role_plans(3, 4)
+    with pytest.raises(RuntimeError):
+        with load.open_snowplan(account, format=format) as writer:
+            writer.write("ROLES", plans)
+            raise RuntimeError
+    names = [entry["name"] for entry in load.iter_plan_from_cache(account)]
+    assert names == list(plans)
+    assert "interrupted" in capsys.readouterr().out
+
+
+def test_arrow_plan_is_smaller_than_jsonl(account):
+    for roles, grants, keep_ok in [(300, 2, True), (300, 50, False), (50, 2000, True)]:
+        plans = role_plans(roles, grants)
+        arrow = write_plan(account, plans, "arrow", keep_ok)
+        jsonl = write_plan(account, plans, "jsonl", keep_ok)
+        assert arrow * 5 < jsonl, (roles, grants, arrow, jsonl)
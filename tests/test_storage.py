@@ -0,0 +1,70 @@
+import os
+import time
+
+from snow_control import storage
+
+
+def test_account_lock_removes_stale_temporary_files(tmp_path):
+    stale = storage.temporary_path(str(tmp_path), ".snowplan")
+    recent = storage.temporary_path(str(tmp_path), ".snowgrants")
+    for path in (stale, recent, tmp_path / ".snowgrants"):
+        with open(path, "w") as f:
+            f.write("{}")
+    old = time.time() - storage.GARBAGE_GRACE_SECONDS - 60
+    os.utime(stale, (old, old))
+    os.utime(tmp_path / ".snowgrants", (old, old))
+    with storage.account_lock(str(tmp_path)):
+        pass
+    assert not os.path.exists(stale)
+    # Possibly still being written by a concurrent run
+    assert os.path.exists(recent)
+    assert os.path.exists(tmp_path / ".snowgrants")
+
+
+def test_atomic_write_failure_leaves_no_temporary_file(tmp_path):
+    path = tmp_path / ".snowgrants"
+    try:
+        with storage.atomic_write(str(path)) as f:
+            f.write("partial")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert os.listdir(tmp_path) == []
+
+
+def age(path, seconds=storage.GARBAGE_GRACE_SECONDS + 60):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_sweep_leaves_temporary_files_of_live_writers(account):
+    from snow_control import load
+
+    account_dir = os.path.join(load.CONFIG_DIR, "config", account)
+    with load.open_snowplan(account, format="jsonl") as writer:
+        # A plan fetching grants for over an hour before writing its first role
+        age(writer._temp_path)
+        with storage.account_lock(account_dir):
+            pass
+        assert os.path.exists(writer._temp_path)
+        writer.write("ROLES", {"ANALYST": {"to_grant": [], "to_revoke": []}})
+    assert [entry["name"] for entry in load.iter_plan_from_cache(account)] == [
+        "ANALYST"
+    ]
+    assert not [
+        file for file in os.listdir(account_dir) if file.startswith(storage.TEMP_PREFIX)
+    ]
+
+
+def test_sweep_removes_locks_left_behind(tmp_path):
+    with storage.owned_temporary_path(str(tmp_path), ".snowplan") as path:
+        lock = path + storage.TEMP_LOCK_SUFFIX
+        with open(path, "w") as f:
+            f.write("{}")
+    # The run died after releasing the lock, before removing it and its temporary file
+    with open(lock, "w"):
+        pass
+    age(path)
+    age(lock)
+    storage.remove_temporary_files(str(tmp_path))
+    assert os.listdir(tmp_path) == []